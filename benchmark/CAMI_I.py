@@ -1,5 +1,8 @@
 import os
 
+# k-mer profiles are cached here and reused across datasets and runs
+kmer_cache_dir = 'kmer_cache'
+
 
 def run_CAMI_I(dataset = None):
     if dataset == 'low':
@@ -57,13 +60,11 @@ def run_CAMI_I(dataset = None):
     # composition_profiles: https://github.com/sufforest/SolidBin/blob/master/scripts/gen_kmer.py
     # coverage_profiles:
     # https://github.com/sufforest/SolidBin/blob/master/scripts/gen_cov.sh
+    # (coverage.py produces the same coverage.tsv as gen_cov.sh + Collate.pl in a single pass)
 
-    os.system('python gen_kmer.py {0} 1000 4 {1}/kmer'.format(fasta_file, output))
+    os.system('python gen_kmer.py {0} 1000 4 {1}/kmer {2}'.format(fasta_file, output, kmer_cache_dir))
     os.system('bedtools genomecov -ibam {0} > {1}/coverage/RL_S001__insert_270_cov.txt'.format(bam_files, output))
-    os.system('bash gen_cov.sh {0}/coverage'.format(output))
-    os.system('perl Collate.pl {0}/coverage > {0}/coverage/coverage.csv'.format(output))
-    os.system(
-        'perl -pe "s/,/\t/g;" {0}/coverage/coverage.csv > {0}/coverage/coverage.tsv'.format(output))
+    os.system('python coverage.py {0}/coverage -o {0}/coverage/coverage.tsv -i {1}'.format(output, fasta_file))
 
     # COCACOLA
     os.system('python cocacola.py --contig_file {0} --abundance_profiles {1}/coverage/coverage.tsv --composition_profiles {1}/kmer/kmer.csv --output {1}/COCACOLA_output/result.csv'.format(fasta_file, output))
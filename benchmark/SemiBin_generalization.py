@@ -1,20 +1,46 @@
+"""
+Binning of the SemiBin generalization benchmark.
+
+Run as a script (see parse_args), or import the steps, which work on in-memory
+NumPy arrays and return label arrays:
+
+    graph = build_graph(features, depth, cannot_link, must_link)
+    labels = cluster(graph, lengths)
+    embedding = recluster_embedding(features, depth)
+    sub_labels = recluster(embedding, labels, seeds, lengths)
+
+(depth is None for multi-sample binning; constraints and seeds are given as
+contig indices.) partitioned_cluster and assign_to_centroids are the
+partitioned and length-stratified variants of the clustering step.
+"""
 import argparse
 import os
 import sys
 import numpy as np
 import logging
-from  Bio import SeqIO
 import pandas as pd
-import subprocess
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from atomicwrites import atomic_write
-from Bio.Seq import Seq
-from Bio.SeqRecord import SeqRecord
 import math
+import time
+import random
+import tempfile
 import shutil
 from sklearn.neighbors import kneighbors_graph
-from igraph import Graph
+from sklearn.metrics import pairwise_distances_argmin_min
+from scipy.sparse import coo_matrix
+from igraph import Graph, VertexClustering
 import warnings
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from threadpoolctl import threadpool_limits
+from feature_store import load_features
+from markers import run_marker_scan, parse_domtblout, select_seeds, MarkerCache
+from tool_runner import RunReport, ToolError
+from bin_output import BinList, MultiFastaWriter
+from checkpoint import Checkpoints, input_hash, file_hash
+from fasta_utils import IndexedFasta, get_threshold, is_binned_short
 
 
 
@@ -22,7 +48,8 @@ def parse_args(args):
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
                                      description='Semi-supervised siamese neural network for metagenomic binning')
     parser.add_argument('-n',required=True, dest='n_sample',type=int)
-    parser.add_argument('--data', required=True, dest='data', type=str)
+    parser.add_argument('--data', required=True, dest='data', type=str,
+                        help='Path to data.csv, its .npy/.parquet/.feather equivalent or a feature store file (.features).')
     parser.add_argument('-i','--input-fasta',
                         required=True,
                         help='Path to the input contig fasta file.',
@@ -69,8 +96,101 @@ def parse_args(args):
                         dest='max_node',
                         default=1,
                         help='Percentage of contigs that considered to be binned.')
+    parser.add_argument('-t', '--threads',
+                        required=False,
+                        type=int,
+                        help='Total number of threads used by kNN, FragGeneScan, hmmsearch, BLAS/OpenMP and the recluster workers.',
+                        dest='threads',
+                        default=os.cpu_count() or 1)
+    parser.add_argument('--tool-timeout',
+                        required=False,
+                        type=float,
+                        help='Seconds allowed to each FragGeneScan/hmmsearch call (default: no limit).',
+                        dest='tool_timeout',
+                        default=None)
+    parser.add_argument('--recluster-workers',
+                        required=False,
+                        type=int,
+                        help='Number of bins reclustered in parallel (the --threads budget is split among them).',
+                        dest='recluster_workers',
+                        default=1)
+    parser.add_argument('--recluster-engine',
+                        required=False,
+                        choices=['kmeans', 'minibatch', 'auto'],
+                        help='KMeans used to recluster bins: full KMeans (float64) or mini-batch KMeans (float32); auto: mini-batch KMeans for bins of more than --minibatch-threshold contigs.',
+                        dest='recluster_engine',
+                        default='kmeans')
+    parser.add_argument('--minibatch-threshold',
+                        required=False,
+                        type=int,
+                        help='Number of contigs above which --recluster-engine auto uses mini-batch KMeans.',
+                        dest='minibatch_threshold',
+                        default=50000)
+    parser.add_argument('--recluster-compare',
+                        required=False,
+                        action='store_true',
+                        help='Also fit full KMeans on the bins reclustered with mini-batch KMeans and save the inertias to recluster_inertia.tsv.',
+                        dest='recluster_compare')
+    parser.add_argument('--graph-min-length',
+                        required=False,
+                        type=int,
+                        help='Length-stratified binning: only contigs of at least this length are clustered with infomap; shorter contigs join the bin with the nearest centroid.',
+                        dest='graph_min_length',
+                        default=None)
+    parser.add_argument('--short-max-distance',
+                        required=False,
+                        type=float,
+                        help='Largest embedding distance of a short contig to a bin centroid for it to join the bin (default: the 95th percentile of the distances of the long contigs to their own bin centroid).',
+                        dest='short_max_distance',
+                        default=None)
+    parser.add_argument('--clustering',
+                        required=False,
+                        choices=CLUSTERING_METHODS,
+                        help='Community detection on the contig graph (wall time, modularity and codelength are logged and saved to run_report.json).',
+                        dest='clustering',
+                        default='infomap')
+    parser.add_argument('--infomap-trials',
+                        required=False,
+                        type=int,
+                        help='Number of infomap trials, run in parallel processes (up to --threads) on the serialized graph; the partition with the lowest codelength is kept (default: igraph\'s 10 trials in one process).',
+                        dest='infomap_trials',
+                        default=None)
+    parser.add_argument('--partitions',
+                        required=False,
+                        type=int,
+                        help='Partitioned clustering: split the contigs into this many coarse KMeans groups, cluster each group separately and merge the clusters split at group boundaries.',
+                        dest='partitions',
+                        default=None)
+    parser.add_argument('--partition-workers',
+                        required=False,
+                        type=int,
+                        help='Number of groups clustered in parallel with --partitions (default: up to --threads; the --threads budget is split among them).',
+                        dest='partition_workers',
+                        default=None)
+    parser.add_argument('--force',
+                        required=False,
+                        action='store_true',
+                        help='Recompute every stage instead of loading the checkpoints of a previous run from <output>/checkpoints.',
+                        dest='force')
+    parser.add_argument('--bin-output',
+                        required=False,
+                        choices=['files', 'multifasta', 'multifasta.gz'],
+                        help='One fasta file per bin, or a single (bgzip-compressed) multi-FASTA with a contig-to-bin table per bin directory (see bin_output.py).',
+                        dest='bin_output',
+                        default='files')
+    parser.add_argument('--marker-cache',
+                        required=False,
+                        help='Directory of a marker result cache shared across runs (assembly marker hits and per-bin seeds).',
+                        dest='marker_cache',
+                        default=None)
+    parser.add_argument('--marker-cache-size',
+                        required=False,
+                        type=float,
+                        help='Size limit of the marker cache in GB (least recently used entries are evicted).',
+                        dest='marker_cache_size',
+                        default=4)
 
-    return parser.parse_args()
+    return parser.parse_args(args[1:])
 
 def validate_args(args):
 
@@ -82,112 +202,623 @@ def validate_args(args):
     except_file(args.contig_fasta)
 
 
-def get_threshold(contig_len):
+def bin_members(contig_labels):
     """
-    calculate the threshold length for must link breaking up
+    Returns a dict label -> array of the indices of the contigs in that bin (-1 is unbinned)
     """
-    basepair_sum = 0
-    threshold = 0
-    whole_len = np.sum(contig_len)
-    contig_len.sort(reverse = True)
-    index = 0
-    while(basepair_sum / whole_len < 0.98):
-        basepair_sum += contig_len[index]
-        threshold = contig_len[index]
-        index += 1
-    threshold = max(threshold, 4000)
-    return threshold
+    contig_labels = np.asarray(contig_labels)
+    order = np.argsort(contig_labels, kind='stable')
+    labels, starts = np.unique(contig_labels[order], return_index=True)
+    members = np.split(order, starts[1:])
+    return {label: index for label, index in zip(labels.tolist(), members) if label != -1}
+
 
-def write_bins(namelist,contig_labels,output, contig_dict , recluster = False,origin_label=0):
-    from collections import defaultdict
-    res = defaultdict(list)
-    for label, name in zip(contig_labels, namelist):
-        if label != -1:
-            res[label].append(name)
+def bin_name(label, recluster=False, origin_label=0):
+    if not recluster:
+        return 'bin.{}'.format(label)
+    return 'recluster_{0}.bin.{1}'.format(origin_label, label)
+
+
+def write_bins(namelist,contig_labels,output, fasta, recluster = False,origin_label=0, threads=1, writer=None):
+    """
+    Write every bin of at least 200 kbp to `output`
+
+    Bin sizes are summed from the fasta index lengths, and the bins that
+    pass are written `threads` at a time, copying the sequence lines of the
+    contigs from the source file (fasta: fasta_utils.IndexedFasta). With a
+    `writer` (bin_output.MultiFastaWriter or BinList), the bins are added to
+    it instead of being written to separate files.
+
+    Returns the labels of the bins that were written
+    """
+    res = bin_members(contig_labels)
 
     os.makedirs(output, exist_ok=True)
 
-    for label in res:
-        bin = []
-        whole_bin_bp = 0
-        for contig in res[label]:
-            rec = SeqRecord(Seq(str(contig_dict[contig])), id=contig, description='')
-            bin.append(rec)
-            whole_bin_bp += len(str(contig_dict[contig]))
-        if not recluster:
-            if whole_bin_bp >= 200000:
-                with atomic_write(os.path.join(output, 'bin.{}.fa'.format(label)), overwrite=True) as ofile:
-                    SeqIO.write(bin, ofile, 'fasta')
-        else:
-            if whole_bin_bp >= 200000:
-                with atomic_write(os.path.join(output, 'recluster_{0}.bin.{1}.fa'.format(origin_label,label)), overwrite=True) as ofile:
-                    SeqIO.write(bin, ofile, 'fasta')
+    lengths = fasta.lengths[[fasta.index[contig] for contig in namelist]]
+    written = [label for label in res if lengths[res[label]].sum() >= 200000]
+    if writer is not None:
+        for label in written:
+            writer.add_bin(bin_name(label, recluster, origin_label), [namelist[index] for index in res[label]])
+        return written
+
+    def write_bin(label):
+        bin_file = os.path.join(output, bin_name(label, recluster, origin_label) + '.fa')
+        with atomic_write(bin_file, mode='wb', overwrite=True) as ofile:
+            fasta.write_records(ofile, [namelist[index] for index in res[label]])
+
+    if threads > 1 and len(written) > 1:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(write_bin, written))
+    else:
+        for label in written:
+            write_bin(label)
+    return written
 
 
 def cal_kl(m1,m2,v1,v2):
-        m1 = max(m1,1e-6)
-        m2 = max(m2,1e-6)
-        v1 = 1 if v1 < 1 else v1
-        v2 = 1 if v2 < 1 else v2
+        """
+        Depth distance of contig pairs (element-wise over arrays of means and variances)
+        """
+        m1 = np.maximum(m1,1e-6)
+        m2 = np.maximum(m2,1e-6)
+        v1 = np.where(v1 < 1, 1, v1).astype(m1.dtype)
+        v2 = np.where(v2 < 1, 1, v2).astype(m1.dtype)
         value = np.log(np.sqrt(v2 / v1)) + np.divide(np.add(v1,np.square(m1 - m2)),2 * v2) - 0.5
-        return min(max(value,1e-6),1-1e-6)
-
-def cal_num_bins(fasta_path,contig_output,hmm_output,seed_output,binned_short):
-
-    if not os.path.exists(contig_output + '.faa'):
-
-        frag_out_log = open(contig_output + '.out','w')
-        subprocess.check_call(
-            ['run_FragGeneScan.pl',
-             '-genome={}'.format(fasta_path),
-             '-out={}'.format(contig_output),
-             '-complete=0',
-             '-train=complete',
-             '-thread=48',
-             ],
-            stdout = frag_out_log,
-            stderr = subprocess.DEVNULL,
-        )
-
-
-    if not os.path.exists(hmm_output):
-
-        hmm_out_log = open(hmm_output+'.out','w')
-        subprocess.check_call(
-            ['hmmsearch',
-             '--domtblout',
-             hmm_output,
-             '--cut_tc',
-             '--cpu', str(48),
-             'marker.hmm',
-             contig_output+'.faa',
-            ],
-            stdout=hmm_out_log,
-            stderr=subprocess.DEVNULL,
-        )
-
-    if not os.path.exists(seed_output):
-            if binned_short:
-                getmarker = 'test_getmarker.pl'
-                subprocess.check_call(
-                    ['perl', getmarker,
-                     hmm_output,
-                     fasta_path,
-                     str(1001),
-                     seed_output,
-                     ],
-                )
+        return np.clip(value,1e-6,1-1e-6)
 
-            else:
-                getmarker =  'test_getmarker.pl'
-                subprocess.check_call(
-                    ['perl', getmarker,
-                     hmm_output,
-                     fasta_path,
-                     str(2501),
-                     seed_output,
-                     ],
-                )
+EDGE_CHUNK = 1 << 20
+
+def depth_similarity(depth, rows, cols, n_sample):
+    """
+    Mean over samples of 1 - cal_kl for the contig pairs (rows[i], cols[i])
+    (depth columns: mean and variance of each sample)
+
+    Computed in float64 whatever the depth dtype: in float32, 1 - cal_kl of
+    the most dissimilar pairs stays above the 1e-6 edge cut-off.
+    """
+    similarity = np.zeros(len(rows), dtype=np.float64)
+    for start in range(0, len(rows), EDGE_CHUNK):
+        r = depth[rows[start:start + EDGE_CHUNK]].astype(np.float64)
+        c = depth[cols[start:start + EDGE_CHUNK]].astype(np.float64)
+        total = np.zeros(len(r), dtype=np.float64)
+        for k in range(n_sample):
+            total += 1 - cal_kl(r[:, 2*k], c[:, 2*k], r[:, 2*k+1], c[:, 2*k+1])
+        similarity[start:start + EDGE_CHUNK] = total / n_sample
+    return similarity
+
+# edges: (n_edges, 2) vertex index pairs; weights: float64 edge weights
+ContigGraph = namedtuple('ContigGraph', ['edges', 'weights', 'n_vertices'])
+
+def build_graph(features, depth=None, cannot_link=None, must_link=None, max_edges=200, max_node=1, threads=1):
+    """
+    Contig graph for clustering: each contig is linked to its `max_edges`
+    nearest neighbours in the feature space (similarity 1 - distance), with
+    cannot-link pairs removed and must-link pairs set to 1. The similarity
+    cut-off is lowered from 0.95 in steps of 0.05 until a `max_node` fraction
+    of the contigs keeps an edge; for single-sample binning, the similarities
+    are multiplied by the depth similarity.
+
+    The kNN graph is kept sparse: entries (i, j) are the j-th neighbours of
+    contig i, and only pairs with i < j become edges.
+
+    features: (n_contigs, n_features) array (k-mer, plus depth columns for
+    multi-sample binning)
+    depth: (n_contigs, 2 * n_samples) depth mean/variance columns weighting
+    the edges, or None (multi-sample binning)
+    cannot_link, must_link: arrays of (i, j) contig index pairs
+
+    Returns a ContigGraph, with edges sorted by (i, j)
+    """
+    n = len(features)
+    # one BLAS thread per kNN job keeps the total within the thread budget
+    with threadpool_limits(limits=1):
+        knn = kneighbors_graph(features, n_neighbors=max_edges, mode='distance', p=2, n_jobs=threads).tocoo()
+    similarity = knn.data.copy()
+    similarity[(similarity >= 1) | (similarity == 0)] = 1
+    similarity = 1 - similarity
+    keys = knn.row.astype(np.int64) * n + knn.col
+
+    if cannot_link is not None and len(cannot_link):
+        cannot_keys = cannot_link[:, 0].astype(np.int64) * n + cannot_link[:, 1]
+        similarity[np.isin(keys, cannot_keys)] = 0
+    if must_link is not None and len(must_link):
+        must_keys = np.unique(must_link[:, 0].astype(np.int64) * n + must_link[:, 1])
+        keep = ~np.isin(keys, must_keys)
+        keys = np.concatenate([keys[keep], must_keys])
+        similarity = np.concatenate([similarity[keep], np.ones(len(must_keys), dtype=similarity.dtype)])
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    similarity = similarity[order]
+    rows = keys // n
+    cols = keys % n
+
+    # largest similarity of every contig, to count the contigs with an edge above the cut-off
+    row_max = np.zeros(n, dtype=similarity.dtype)
+    np.maximum.at(row_max, rows, similarity)
+    threshold = 0.95
+    while (threshold >= 0):
+        num = np.count_nonzero(row_max > threshold)
+        if round(num / n, 2) >= max_node:
+            break
+        else:
+            threshold -= 0.05
+
+    upper = (similarity > threshold) & (rows < cols)
+    rows = rows[upper]
+    cols = cols[upper]
+    weights = similarity[upper].astype(np.float64)
+    if depth is not None:
+        weights *= depth_similarity(depth, rows, cols, depth.shape[1] // 2)
+    edges = weights > 1e-6
+    return ContigGraph(np.column_stack([rows[edges], cols[edges]]), weights[edges], n)
+
+def constraint_pairs(link_file, mapObj):
+    """
+    Read a constraint file (contig_1,contig_2 per row) as index pairs,
+    leaving out pairs with a contig that is not in mapObj
+    """
+    pairs = pd.read_csv(link_file, sep=',', header=None).values
+    index = np.array([[mapObj.get(a, -1), mapObj.get(b, -1)] for a, b in pairs[:, :2]], dtype=np.int64).reshape(-1, 2)
+    return index[(index >= 0).all(axis=1)]
+
+def assign_to_centroids(embedding, contig_labels, weights, max_distance=None, quantile=0.95):
+    """
+    Assign the unlabelled contigs (label -1) to the bin with the nearest
+    centroid (weighted mean of the embeddings of its contigs), if that
+    centroid is within `max_distance`. By default, the cut-off is the
+    `quantile` of the distances of the labelled contigs to their own centroid.
+
+    Returns (new labels, cut-off)
+    """
+    labelled = np.flatnonzero(contig_labels >= 0)
+    unlabelled = np.flatnonzero(contig_labels < 0)
+    contig_labels = contig_labels.copy()
+    if not len(labelled) or not len(unlabelled):
+        return contig_labels, max_distance
+    labels, inverse = np.unique(contig_labels[labelled], return_inverse=True)
+    features = np.asarray(embedding[labelled], dtype=np.float64)
+    w = np.asarray(weights[labelled], dtype=np.float64)
+    totals = coo_matrix((w, (inverse, np.arange(len(labelled)))), shape=(len(labels), len(labelled))).tocsr()
+    centroids = (totals @ features) / np.bincount(inverse, weights=w)[:, None]
+    if max_distance is None:
+        own = np.sqrt(np.square(features - centroids[inverse]).sum(axis=1))
+        max_distance = float(np.quantile(own, quantile))
+    nearest, distance = pairwise_distances_argmin_min(np.asarray(embedding[unlabelled], dtype=np.float64), centroids)
+    close = distance <= max_distance
+    contig_labels[unlabelled[close]] = labels[nearest[close]]
+    return contig_labels, max_distance
+
+CLUSTERING_METHODS = ['infomap', 'leiden', 'multilevel']
+
+_infomap_state = {}
+
+def init_infomap(state):
+    _infomap_state.update(state)
+
+def infomap_trial(trial):
+    """
+    One infomap trial on the serialized graph, seeded with the trial number;
+    returns (codelength, membership)
+    """
+    graph = np.load(_infomap_state['path'])
+    g = Graph()
+    g.add_vertices(int(graph['n_vertices']))
+    g.add_edges(graph['edges'].tolist())
+    random.seed(trial)
+    result = g.community_infomap(edge_weights=graph['weights'].tolist(),
+                                 vertex_weights=graph['vertex_weights'].tolist(), trials=1)
+    return result.codelength, result.membership
+
+def parallel_infomap(edges, weights, n_vertices, vertex_weights, trials, workers):
+    """
+    Run `trials` single-trial infomap runs in `workers` processes, which all
+    load the same serialized graph, and keep the partition with the lowest
+    codelength (the first one on ties)
+
+    Returns (codelengths of all trials, best membership)
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'graph.npz')
+        np.savez(path, n_vertices=n_vertices, edges=edges, weights=weights, vertex_weights=vertex_weights)
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context('fork'),
+                                 initializer=init_infomap,
+                                 initargs=({'path': path},)) as executor:
+            results = list(executor.map(infomap_trial, range(trials)))
+    codelengths = [codelength for codelength, _ in results]
+    return codelengths, results[int(np.argmin(codelengths))][1]
+
+def parallel_trials(method, trials, workers):
+    """
+    Whether cluster runs the infomap trials in parallel (seeded trials, see
+    infomap_trial) rather than within igraph: the results differ
+    """
+    return method == 'infomap' and trials is not None and trials > 1 and workers > 1
+
+def cluster(graph, lengths, method='infomap', trials=None, workers=1, info=None):
+    """
+    Communities of a ContigGraph; returns the label of every contig
+
+    lengths: contig lengths (infomap vertex weights)
+    method: infomap, leiden or multilevel (Louvain), both optimising modularity
+    trials: number of infomap trials (default: igraph's); with several
+    `workers`, the trials run in parallel processes
+    info: optional dict, filled with the engine's wall time (cluster_time),
+    the modularity and, for infomap, the codelength
+    """
+    edges, weights, n_vertices = graph
+    vertex_weights = np.asarray(lengths)
+    g = Graph()
+    g.add_vertices(n_vertices)
+    g.add_edges(edges.tolist())
+    edge_weights = weights.tolist()
+    start = time.time()
+    if parallel_trials(method, trials, workers):
+        codelengths, membership = parallel_infomap(edges, weights, n_vertices, vertex_weights,
+                                                   trials, min(trials, workers))
+        result = VertexClustering(g, membership)
+        result.codelength = min(codelengths)
+        if info is not None:
+            info['trial_codelengths'] = codelengths
+    elif method == 'infomap' and trials is not None:
+        result = g.community_infomap(edge_weights=edge_weights, vertex_weights=vertex_weights.tolist(),
+                                     trials=trials)
+    elif method == 'infomap':
+        result = g.community_infomap(edge_weights=edge_weights, vertex_weights=vertex_weights.tolist())
+    elif method == 'leiden':
+        result = g.community_leiden(objective_function='modularity', weights=edge_weights, n_iterations=-1)
+    elif method == 'multilevel':
+        result = g.community_multilevel(weights=edge_weights)
+    else:
+        raise ValueError('Unknown clustering method: {}'.format(method))
+    if info is not None:
+        info['cluster_time'] = time.time() - start
+        info['clusters'] = len(result)
+        info['modularity'] = g.modularity(result.membership, weights=edge_weights) if len(edge_weights) else 0.
+        if method == 'infomap':
+            info['codelength'] = result.codelength
+    return np.array(result.membership, dtype=int)
+
+PARTITION_SAMPLE = 100000
+# boundary contigs are at most this much farther from their own coarse
+# centre than from the next one
+BOUNDARY_RATIO = 1.25
+BOUNDARY_NEIGHBOURS = 10
+# clusters of different groups are merged when this share of their boundary
+# link weight goes between them and their centres are at most MERGE_SPREAD
+# times the larger RMS radius apart
+MERGE_AFFINITY = 0.1
+MERGE_SPREAD = 1.5
+
+_partition_state = {}
+
+def init_partition(state):
+    """
+    Set the data shared by every cluster_partition call (inherited by forked workers)
+    """
+    _partition_state.update(state)
+
+def local_pairs(pairs, position, group_of, group):
+    if pairs is None:
+        return None
+    inside = (group_of[pairs[:, 0]] == group) & (group_of[pairs[:, 1]] == group)
+    return position[pairs[inside]]
+
+def cluster_partition(group):
+    """
+    Build the graph of one coarse group and cluster it; returns the labels
+    of the group's contigs (in index order) and the clustering info
+    """
+    state = _partition_state
+    index = np.flatnonzero(state['group_of'] == group)
+    if len(index) == 1:
+        return np.zeros(1, dtype=int), {'group': int(group), 'contigs': 1, 'edges': 0}
+    position = np.full(len(state['group_of']), -1, dtype=np.int64)
+    position[index] = np.arange(len(index))
+    depth = state['depth']
+    with threadpool_limits(limits=state['threads']):
+        graph = build_graph(state['features'][index], None if depth is None else depth[index],
+                            local_pairs(state['cannot_link'], position, state['group_of'], group),
+                            local_pairs(state['must_link'], position, state['group_of'], group),
+                            min(state['max_edges'], len(index) - 1), state['max_node'],
+                            state['threads'])
+    info = {'group': int(group), 'contigs': len(index), 'edges': len(graph.edges)}
+    labels = cluster(graph, state['lengths'][index], state['method'], state['trials'], info=info)
+    return labels, info
+
+def coarse_groups(embedding, n_groups, sample_size=PARTITION_SAMPLE):
+    """
+    Split the contigs into `n_groups` with KMeans fitted on a random sample
+
+    Returns (group of every contig, boundary mask): boundary contigs are
+    nearly as close to another group's centre as to their own
+    """
+    rng = np.random.default_rng(0)
+    sample = np.sort(rng.choice(len(embedding), min(sample_size, len(embedding)), replace=False))
+    kmeans = KMeans(n_clusters=n_groups, n_init=1, random_state=0).fit(embedding[sample])
+    group_of = np.zeros(len(embedding), dtype=np.int64)
+    boundary = np.zeros(len(embedding), dtype=bool)
+    for start in range(0, len(embedding), EDGE_CHUNK):
+        distance = kmeans.transform(embedding[start:start + EDGE_CHUNK])
+        nearest = np.argsort(distance, axis=1)[:, :2]
+        rows = np.arange(len(distance))
+        group_of[start:start + EDGE_CHUNK] = nearest[:, 0]
+        if n_groups > 1:
+            boundary[start:start + EDGE_CHUNK] = (distance[rows, nearest[:, 1]]
+                                                  <= BOUNDARY_RATIO * distance[rows, nearest[:, 0]])
+    return group_of, boundary
+
+def reconcile_partitions(embedding, labels, group_of, boundary, cannot_link=None, must_link=None):
+    """
+    Merge clusters of different groups that were split by the partition
+
+    Only boundary contigs take part: each is linked to its nearest boundary
+    neighbours (similarity 1 - distance, as in build_graph), and must-link
+    pairs of boundary contigs are links of weight 1, cannot-link pairs are
+    dropped. The affinity of two clusters of different groups is the share of
+    their boundary link weight that goes from one to the other. They are
+    merged when each is the other's strongest partner, their affinity reaches
+    MERGE_AFFINITY and their centres are no farther apart than MERGE_SPREAD
+    times the larger RMS radius, so that clusters which were never split
+    stay apart; in rounds until no pair qualifies.
+
+    Returns the labels renumbered from 0
+    """
+    labels = np.unique(labels, return_inverse=True)[1]
+    candidates = np.flatnonzero(boundary)
+    if len(candidates) < 2:
+        return labels
+    k = min(BOUNDARY_NEIGHBOURS, len(candidates) - 1)
+    knn = kneighbors_graph(embedding[candidates], n_neighbors=k, mode='distance', p=2).tocoo()
+    # directed links: (contig, neighbour)
+    pairs = [np.column_stack([candidates[knn.row], candidates[knn.col]])]
+    similarity = [np.where((knn.data > 0) & (knn.data < 1), 1 - knn.data, 0)]
+    if must_link is not None and len(must_link):
+        must_link = must_link[boundary[must_link[:, 0]] & boundary[must_link[:, 1]]]
+        pairs.extend([must_link, must_link[:, ::-1]])
+        similarity.extend([np.ones(len(must_link)), np.ones(len(must_link))])
+    pairs = np.concatenate(pairs)
+    similarity = np.concatenate(similarity)
+    keep = similarity > 0
+    if cannot_link is not None and len(cannot_link):
+        n = len(labels)
+        forbidden = np.concatenate([cannot_link[:, 0] * n + cannot_link[:, 1], cannot_link[:, 1] * n + cannot_link[:, 0]])
+        keep &= ~np.isin(pairs[:, 0] * n + pairs[:, 1], forbidden)
+    pairs = pairs[keep]
+    similarity = similarity[keep]
+    cross = group_of[pairs[:, 0]] != group_of[pairs[:, 1]]
+    if not cross.any():
+        return labels
+
+    # per-cluster sums for the centres and radii, merged along with the clusters
+    n_clusters = labels.max() + 1
+    size = np.bincount(labels, minlength=n_clusters).astype(np.float64)
+    total = np.zeros((n_clusters, embedding.shape[1]))
+    squares = np.zeros(n_clusters)
+    for start in range(0, len(labels), EDGE_CHUNK):
+        chunk = np.asarray(embedding[start:start + EDGE_CHUNK], dtype=np.float64)
+        np.add.at(total, labels[start:start + EDGE_CHUNK], chunk)
+        np.add.at(squares, labels[start:start + EDGE_CHUNK], np.square(chunk).sum(axis=1))
+
+    while True:
+        a = labels[pairs[:, 0]]
+        b = labels[pairs[:, 1]]
+        # boundary link weight of every cluster (from its contigs)
+        link_weight = np.bincount(a, weights=similarity, minlength=len(size))
+        between = cross & (a != b)
+        links = pd.DataFrame({'a': np.minimum(a, b)[between], 'b': np.maximum(a, b)[between],
+                              'weight': similarity[between]})
+        links = links.groupby(['a', 'b'], as_index=False)['weight'].sum()
+        if not len(links):
+            break
+        la = links['a'].values
+        lb = links['b'].values
+        links['affinity'] = links['weight'].values / (link_weight[la] + link_weight[lb])
+        strongest = pd.concat([links.rename(columns={'a': 'cluster', 'b': 'partner'}),
+                               links.rename(columns={'b': 'cluster', 'a': 'partner'})])
+        strongest = strongest.sort_values(['cluster', 'affinity', 'partner'], ascending=[True, False, True])
+        best = strongest.drop_duplicates('cluster').set_index('cluster')['partner']
+        mutual = (best.reindex(la).values == lb) & (best.reindex(lb).values == la)
+
+        centre = total / size[:, None]
+        radius = np.sqrt(np.maximum(squares / size - np.square(centre).sum(axis=1), 0))
+        distance = np.linalg.norm(centre[la] - centre[lb], axis=1)
+        strong = (mutual & (links['affinity'].values >= MERGE_AFFINITY)
+                  & (distance <= MERGE_SPREAD * np.maximum(radius[la], radius[lb])))
+        if not strong.any():
+            break
+        # mutual best pairs are disjoint, so each round is a single relabelling
+        merged = np.arange(len(size))
+        merged[lb[strong]] = la[strong]
+        kept, merged = np.unique(merged, return_inverse=True)
+        size = np.bincount(merged, weights=size)
+        squares = np.bincount(merged, weights=squares)
+        summed = np.zeros((len(kept), total.shape[1]))
+        np.add.at(summed, merged, total)
+        total = summed
+        labels = merged[labels]
+    return labels
+
+def partitioned_cluster(features, depth, lengths, n_groups, cannot_link=None, must_link=None,
+                        max_edges=200, max_node=1, method='infomap', trials=None,
+                        threads=1, workers=1, info=None, logger=None):
+    """
+    Two-level clustering: coarse KMeans groups, then build_graph + cluster on
+    each group (`workers` groups at a time, in separate processes), then
+    reconcile_partitions on the group boundaries
+
+    The arguments are those of build_graph and cluster; trials run within
+    each group's process. info: optional dict, given the clustering info of
+    every group
+
+    Returns the label of every contig
+    """
+    group_of, boundary = coarse_groups(features, n_groups)
+    groups = [group for group in range(n_groups) if np.any(group_of == group)]
+    if logger is not None:
+        logger.info('Partitioned clustering: {} groups of {} to {} contigs, {} boundary contigs.'.format(
+            len(groups), np.bincount(group_of)[groups].min(), np.bincount(group_of)[groups].max(),
+            np.count_nonzero(boundary)))
+    n_workers = max(1, min(workers, threads, len(groups)))
+    state = {
+        'features': features,
+        'depth': depth,
+        'lengths': np.asarray(lengths),
+        'group_of': group_of,
+        'max_edges': max_edges,
+        'max_node': max_node,
+        'cannot_link': cannot_link,
+        'must_link': must_link,
+        'threads': max(1, threads // n_workers),
+        'method': method,
+        'trials': trials,
+    }
+    # the largest groups are started first
+    schedule = sorted(groups, key=lambda group: -np.count_nonzero(group_of == group))
+    if n_workers == 1:
+        init_partition(state)
+        results = [cluster_partition(group) for group in schedule]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 mp_context=multiprocessing.get_context('fork'),
+                                 initializer=init_partition,
+                                 initargs=(state,)) as executor:
+            results = list(executor.map(cluster_partition, schedule))
+
+    labels = np.zeros(len(features), dtype=int)
+    offset = 0
+    results = sorted(zip(schedule, results), key=lambda item: item[0])
+    for group, (group_labels, _) in results:
+        labels[group_of == group] = group_labels + offset
+        offset += group_labels.max() + 1
+    if info is not None:
+        info['groups'] = [group_info for _, (_, group_info) in results]
+    reconciled = reconcile_partitions(features, labels, group_of, boundary, cannot_link, must_link)
+    if logger is not None:
+        logger.info('Partitioned clustering: {} clusters, {} after reconciling group boundaries.'.format(
+            offset, reconciled.max() + 1))
+    return reconciled
+
+MINIBATCH_SIZE = 4096
+
+def fit_kmeans(features, init, sample_weight, minibatch=False):
+    """
+    Weighted KMeans initialised on the seed embeddings (n_init=1): full
+    KMeans in float64, as the original reclustering, or mini-batch KMeans on
+    float32 features when `minibatch`
+    """
+    dtype = np.float32 if minibatch else np.float64
+    features = np.asarray(features, dtype=dtype)
+    init = np.asarray(init, dtype=dtype)
+    if minibatch:
+        kmeans = MiniBatchKMeans(n_clusters=len(init), init=init, n_init=1,
+                                 batch_size=MINIBATCH_SIZE, random_state=0)
+    else:
+        kmeans = KMeans(n_clusters=len(init), init=init, n_init=1)
+    kmeans.fit(features, sample_weight=sample_weight)
+    return kmeans
+
+def recluster_kmeans(features, seeds_embedding, weights, engine='kmeans', minibatch_threshold=50000, compare=False):
+    """
+    Split one bin with KMeans initialised on the embeddings of its seeds
+
+    engine: kmeans, minibatch or auto (mini-batch KMeans above
+    `minibatch_threshold` contigs); with `compare`, mini-batch fits are
+    repeated with full KMeans to record its inertia
+
+    Returns (labels, record of the engine, inertia and wall time)
+    """
+    if engine == 'auto':
+        engine = 'minibatch' if len(features) > minibatch_threshold else 'kmeans'
+    record = {'contigs': len(features), 'clusters': len(seeds_embedding), 'engine': engine}
+    start = time.time()
+    kmeans = fit_kmeans(features, seeds_embedding, weights, minibatch=engine == 'minibatch')
+    record['wall_time'] = time.time() - start
+    record['inertia'] = kmeans.inertia_
+    if compare and engine == 'minibatch':
+        start = time.time()
+        record['full_inertia'] = fit_kmeans(features, seeds_embedding, weights).inertia_
+        record['full_wall_time'] = time.time() - start
+    return kmeans.labels_, record
+
+def recluster_embedding(features, depth=None):
+    """
+    Embedding used for reclustering: for single-sample binning, the depth
+    means (/100) are appended to the k-mer features, scaled to a weight
+    comparable to them
+    """
+    if depth is None:
+        return features
+    depth_mean = depth[:, 0::2] / 100
+    scaling = np.mean(np.abs(features)) / np.mean(depth_mean)
+    base = 10
+    weight = 2 * base * math.ceil(scaling / base)
+    return np.concatenate((features, depth_mean * weight), axis=1)
+
+def recluster(embedding, labels, seeds, lengths, engine='kmeans', minibatch_threshold=50000, threads=1):
+    """
+    Split every bin that has seeds with KMeans initialised on its seed contigs
+
+    embedding: (n_contigs, d) array (see recluster_embedding)
+    labels: bin label of every contig (-1: unbinned)
+    seeds: dict bin label -> indices of its seed contigs
+    lengths: contig lengths (KMeans sample weights)
+
+    Returns the label of every contig within its bin, -1 for contigs of bins
+    without seeds and unbinned contigs
+    """
+    lengths = np.asarray(lengths)
+    sub_labels = np.full(len(labels), -1, dtype=int)
+    members = bin_members(labels)
+    with threadpool_limits(limits=threads):
+        for label, seed_index in seeds.items():
+            contig_index = members[label]
+            sub_labels[contig_index], _ = recluster_kmeans(embedding[contig_index], embedding[seed_index],
+                                                           lengths[contig_index], engine, minibatch_threshold)
+    return sub_labels
+
+_recluster_state = {}
+
+def init_recluster(state):
+    """
+    Set the data shared by every recluster_bin call (inherited by forked workers)
+    """
+    _recluster_state.update(state)
+
+def recluster_bin(label, seed):
+    """
+    Split one bin with KMeans initialised on its seed contigs, or copy it
+    unchanged when it has no seeds
+
+    Returns (bins, record): in multi-FASTA output mode, bins is a
+    bin_output.BinList of the resulting bins for the parent process to write
+    (None otherwise); record holds the KMeans engine, inertia and wall time
+    (None for a copied bin), and the inertia of full KMeans when comparing.
+    """
+    state = _recluster_state
+    contig_index = state['members'][label]
+    collected = BinList() if state['multifasta'] else None
+    if seed is None:
+        if collected is not None:
+            collected.add_bin(bin_name(label), [state['namelist'][i] for i in contig_index])
+        else:
+            shutil.copy(os.path.join(state['output_bin_path'], bin_name(label) + '.fa'), state['recluster_path'])
+        return collected, None
+
+    embedding_new = state['embedding']
+    contig_list = [state['namelist'][i] for i in contig_index]
+    re_bin_features = embedding_new[contig_index]
+    seed_index = [state['mapObj'][temp] for temp in seed]
+    length_weight = state['contig_length'][contig_index]
+    seeds_embedding = embedding_new[seed_index]
+    with threadpool_limits(limits=state['threads']):
+        labels, record = recluster_kmeans(re_bin_features, seeds_embedding, length_weight, state['engine'],
+                                          state['minibatch_threshold'], state['compare'])
+    record = dict(bin=label, **record)
+    write_bins(contig_list, labels, state['recluster_path'], state['fasta'],
+               recluster=True, origin_label=label, threads=state['threads'], writer=collected)
+    return collected, record
 
 def main(args=None):
     if args is None:
@@ -195,195 +826,290 @@ def main(args=None):
 
     args = parse_args(args)
     validate_args(args)
+    if args.partition_workers is None:
+        args.partition_workers = args.threads
+    threadpool_limits(limits=args.threads)
 
 
     logger = logging.getLogger('SemiBin')
     logger.setLevel(logging.INFO)
 
-    sh = logging.StreamHandler()
-    sh.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
-    logger.addHandler(sh)
+    if not logger.handlers:
+        sh = logging.StreamHandler()
+        sh.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+        logger.addHandler(sh)
 
     out = args.output
     if not os.path.exists(out):
         os.mkdir(out)
+    report = RunReport(os.path.join(out, 'run_report.json'))
 
 
 
-    whole_contig_bp = 0
-    contig_bp_2500 = 0
-    contig_length_list = []
-    contig_length_dict = {}
-    contig_dict = {}
-    for seq_record in SeqIO.parse(args.contig_fasta , "fasta"):
-        if len(seq_record) >= 1000 and len(seq_record) <= 2500:
-            contig_bp_2500 += len(seq_record)
-        contig_length_list.append(len(seq_record))
-        whole_contig_bp += len(seq_record)
-        contig_length_dict[str(seq_record.id).strip('')] = len((seq_record.seq))
-        contig_dict[str(seq_record.id).strip('')] = str(seq_record.seq)
+    fasta = IndexedFasta(args.contig_fasta)
+    contig_length_dict = dict(zip(fasta.names, fasta.lengths))
 
     # threshold for generating must link pairs
-    threshold = get_threshold(contig_length_list)
+    threshold = get_threshold(fasta.lengths)
 
-    if contig_bp_2500 / whole_contig_bp >= 0.05:
-        binned_short = False
-    else:
-        binned_short = True
+    binned_short = is_binned_short(fasta.lengths)
 
 
     # generating coverage for every contig and for must link pair
 
-    data = pd.read_csv(os.path.join(out, 'data.csv'), index_col=0)
+    namelist, train_data = load_features(args.data)
 
-    kmer = data.values[:,0:136]
-    depth = data.values[:,136:len(data.values[0])]
+    kmer = train_data[:,0:136]
+    depth = train_data[:,136:train_data.shape[1]]
 
 
-    namelist = data.index.tolist()
     mapObj = dict(zip(namelist, range(len(namelist))))
-    row_index = data._stat_axis.values.tolist()
-    train_data = data.values
 
     n_sample = args.n_sample
-    print(n_sample)
     is_combined = True if n_sample >= 5 else False
 
     if not is_combined:
         train_data_input = train_data[:,0:136]
+        # single-sample binning weights the graph edges by depth similarity
+        edge_depth = depth[:, :2 * n_sample]
     else:
         train_data_input = train_data
+        edge_depth = None
 
-    #x = torch.from_numpy(train_data_input)
-    print(train_data_input.shape)
-    print(args.max_edges)
+    logger.info('Samples: {}, features: {} contigs x {} columns, max edges: {}.'.format(
+        n_sample, train_data_input.shape[0], train_data_input.shape[1], args.max_edges))
     embedding = train_data_input
-    embedding_matrix = kneighbors_graph(embedding, n_neighbors=args.max_edges, mode='distance', p=2, n_jobs=-1).toarray()
-
-    embedding_matrix[embedding_matrix >= 1] = 1
-    embedding_matrix[embedding_matrix == 0] = 1
-    embedding_matrix = 1 - embedding_matrix
-
-
-
-    #cannot_list = pd.read_csv('/home1/pansj/binning/CAMI_medium/mmseqs_solidbin/medium_cannot.txt', sep=',',header=None).values
-    #cannot_list = pd.read_csv('/share/inspurStorage/home1/pansj/binning/CAMI_low/mmseqs_solidbin/low_cannot.txt', sep=',',header=None).values
+    contig_length = np.array([contig_length_dict[name] for name in namelist])
 
+    cannot_link = must_link = None
     if args.cannot_link is not None:
-        print('can not link')
-        cannot_list = pd.read_csv(args.cannot_link,sep=',',header=None).values
-        print(len(cannot_list))
-        for temp in cannot_list:
-            embedding_matrix[mapObj[temp[0]]][mapObj[temp[1]]] = 0
-
+        cannot_link = constraint_pairs(args.cannot_link, mapObj)
+        logger.info('Cannot-link pairs: {}.'.format(len(cannot_link)))
     if args.must_link is not None:
-        print('must link')
-        must_list = pd.read_csv(args.must_link,sep=',',header=None).values
-        print(len(must_list))
-        for temp in must_list:
-            embedding_matrix[mapObj[temp[0]]][mapObj[temp[1]]] = 1
-    print(embedding_matrix.shape)
-    threshold = 0.95
+        must_link = constraint_pairs(args.must_link, mapObj)
+        logger.info('Must-link pairs: {}.'.format(len(must_link)))
 
-    while (threshold >= 0):
-        num = len(list(set(np.where(embedding_matrix > threshold)[0])))
-        if round(num / len(embedding_matrix), 2) >= args.max_node:
-            break
-        else:
-            threshold -= 0.05
+    embedding_new = recluster_embedding(embedding, edge_depth)
 
-    embedding_matrix[embedding_matrix <= threshold] = 0
-    if not is_combined:
-        logger.info('Calculating depth matrix.')
-        depth_matrix = np.zeros(shape=embedding_matrix.shape)
-        for i in range(len(embedding_matrix)):
-            for j in range(i + 1, len(embedding_matrix)):
-                if embedding_matrix[i][j] > 0:
-                        temp_depth = 0
-                        for k in range(n_sample):
-                            temp_depth  += 1 - cal_kl(depth[i][2*k], depth[j][2*k], depth[i][2*k+1], depth[j][2*k+1])
-                        depth_matrix[i][j] = temp_depth / n_sample
-
-        matrix = embedding_matrix * depth_matrix
+    # length-stratified mode: only the long contigs are graph vertices
+    if args.graph_min_length is not None:
+        graph_index = np.flatnonzero(contig_length >= args.graph_min_length)
+        position = np.full(len(namelist), -1, dtype=np.int64)
+        position[graph_index] = np.arange(len(graph_index))
+        if cannot_link is not None:
+            cannot_link = position[cannot_link]
+            cannot_link = cannot_link[(cannot_link >= 0).all(axis=1)]
+        if must_link is not None:
+            must_link = position[must_link]
+            must_link = must_link[(must_link >= 0).all(axis=1)]
+        logger.info('Graph on {} of {} contigs (>= {} bp).'.format(len(graph_index), len(namelist), args.graph_min_length))
     else:
-        matrix = embedding_matrix
-
-    edges = []
-    edges_weight = []
-
-    for i in range(len(matrix)):
-        for j in range(i + 1, len(matrix)):
-            if matrix[i][j] > 1e-6:
-                edges.append((i, j))
-                edges_weight.append(matrix[i][j])
+        graph_index = np.arange(len(namelist))
 
-    logger.info('Edges:{}'.format(len(edges)))
+    checkpoints = Checkpoints(out, args.force, logger)
+    fasta_key = input_hash('\n'.join(fasta.names), fasta.lengths, fasta.offsets,
+                           os.path.getsize(args.contig_fasta))
+    inputs_key = input_hash('\n'.join(namelist), np.asarray(embedding), None if is_combined else np.asarray(edge_depth),
+                            n_sample, contig_length, cannot_link, must_link, graph_index)
+    partitioned = args.partitions is not None and args.partitions > 1
+    # partitions cluster within one process each: igraph runs their trials
+    trial_path = not partitioned and parallel_trials(args.clustering, args.infomap_trials, args.threads)
+    clustering_key = input_hash('clustering', inputs_key, args.max_edges, args.max_node, args.clustering,
+                                args.infomap_trials, trial_path, args.partitions, args.short_max_distance)
+    checkpoint = checkpoints.load('clustering', clustering_key)
+    if checkpoint is not None:
+        contig_labels = checkpoint['labels']
+    else:
+        contig_labels = np.full(len(namelist), -1, dtype=int)
+        with report.timed('clustering', method=args.clustering, contigs=len(graph_index)) as record:
+            if partitioned:
+                contig_labels[graph_index] = partitioned_cluster(
+                    embedding[graph_index], None if is_combined else edge_depth[graph_index],
+                    contig_length[graph_index], args.partitions, cannot_link, must_link,
+                    args.max_edges, args.max_node, args.clustering, args.infomap_trials,
+                    args.threads, args.partition_workers, record, logger)
+            else:
+                graph_key = input_hash('graph', inputs_key, args.max_edges, args.max_node)
+                graph = checkpoints.load('graph', graph_key)
+                if graph is not None:
+                    graph = ContigGraph(graph['edges'], graph['weights'], len(graph_index))
+                else:
+                    graph = build_graph(embedding[graph_index], None if is_combined else edge_depth[graph_index],
+                                        cannot_link, must_link, args.max_edges, args.max_node, args.threads)
+                    checkpoints.save('graph', graph_key, edges=graph.edges, weights=graph.weights)
+                logger.info('Edges:{}'.format(len(graph.edges)))
+                record['edges'] = len(graph.edges)
+                contig_labels[graph_index] = cluster(graph, contig_length[graph_index], args.clustering,
+                                                     args.infomap_trials, args.threads, record)
+                logger.info('{}: {} clusters in {:.2f}s, modularity {:.4f}{}.'.format(
+                    args.clustering, record['clusters'], record['cluster_time'], record['modularity'],
+                    ', codelength {:.4f}'.format(record['codelength']) if 'codelength' in record else ''))
 
-    g = Graph()
-    vertex = list(range(len(matrix)))
-    g.add_vertices(vertex)
-    g.add_edges(edges)
-    length_weight = np.array([contig_length_dict[name] for name in namelist])
-    result = g.community_infomap(edge_weights=edges_weight,vertex_weights=length_weight)
-    contig_labels = np.zeros(shape=(len(matrix)), dtype=np.int)
-
-    for i in range(len(result)):
-        temp = result[i]
-        for infomap_index in temp:
-            contig_labels[infomap_index] = i
+        if args.graph_min_length is not None:
+            n_short = len(namelist) - len(graph_index)
+            contig_labels, max_distance = assign_to_centroids(embedding_new, contig_labels, contig_length,
+                                                              args.short_max_distance)
+            if n_short:
+                logger.info('Assigned {} of {} short contigs to the nearest bin centroid (distance <= {:.4g}).'.format(
+                    n_short - np.count_nonzero(contig_labels < 0), n_short, max_distance))
+        checkpoints.save('clustering', clustering_key, labels=contig_labels)
 
     output_bin_path = os.path.join(out,'output_bins')
-    if not os.path.exists(output_bin_path):
-        os.mkdir(output_bin_path)
 
-    write_bins(namelist, contig_labels, output_bin_path, contig_dict)
-    if not is_combined:
-        mean_index = [2 * temp for temp in range(n_sample)]
-        depth_mean = depth[:, mean_index] / 100
-        scaling = np.mean(np.abs(embedding)) / np.mean(depth_mean)
-        base = 10
-        weight = 2 * base * math.ceil(scaling / base)
-        embedding_new = np.concatenate((embedding, depth_mean * weight), axis=1)
+    multifasta = args.bin_output != 'files'
+    compress = args.bin_output == 'multifasta.gz'
+    bins_key = input_hash('bins', clustering_key, fasta_key, args.bin_output)
+    checkpoint = checkpoints.load('bins', bins_key)
+    if checkpoint is not None:
+        written_bins = checkpoint['written'].tolist()
     else:
-        embedding_new = embedding
+        # bins of an earlier run with other labels must not be left behind
+        shutil.rmtree(output_bin_path, ignore_errors=True)
+        os.makedirs(output_bin_path)
+        writer = MultiFastaWriter(output_bin_path, fasta, compress) if multifasta else None
+        written_bins = write_bins(namelist, contig_labels, output_bin_path, fasta, threads=args.threads, writer=writer)
+        if writer is not None:
+            writer.close()
+        checkpoints.save('bins', bins_key, written=np.array(written_bins, dtype=np.int64))
 
-    bin_files = os.listdir(output_bin_path)
     logger.info('Reclustering.')
+    recluster_path = os.path.join(out, 'output_recluster_bins')
+    members = bin_members(contig_labels)
+
+    # gene calling and the marker search run once, on the whole assembly,
+    # and the seeds of all bins are selected together
+    min_len = 1001 if binned_short else 2501
+    # the marker outputs depend on the sequences, which fasta_key does not cover
+    markers_key = input_hash('markers', file_hash(args.contig_fasta), file_hash('marker.hmm'))
+    seeds_key = input_hash('seeds', bins_key, min_len, markers_key)
+    checkpoint = checkpoints.load('seeds', seeds_key)
+    seeds_complete = True
+    if checkpoint is not None:
+        bin_seeds = {}
+        for label, contig in zip(checkpoint['labels'].tolist(), checkpoint['contigs'].tolist()):
+            bin_seeds.setdefault(label, []).append(contig)
+    else:
+        bin_seeds = {}
+        pending = written_bins
+        cache = None
+        if args.marker_cache is not None:
+            cache = MarkerCache(args.marker_cache, int(args.marker_cache_size * 1024 ** 3))
+            bin_keys = {}
+            pending = []
+            for label in written_bins:
+                bin_keys[label] = cache.bin_key([namelist[i] for i in members[label]], fasta, min_len)
+                cached = cache.get_bin(bin_keys[label])
+                if cached is None:
+                    pending.append(label)
+                elif cached:
+                    bin_seeds[label] = cached
+            logger.info('Marker cache: {} of {} bins found.'.format(len(written_bins) - len(pending), len(written_bins)))
 
-    for bin in bin_files:
-        if os.path.exists(os.path.join(output_bin_path, bin)):
-            contig_list = []
-            for seq_record in SeqIO.parse(os.path.join(output_bin_path, bin), "fasta"):
-                contig_list.append(seq_record.id)
-            contig_output = os.path.join(output_bin_path, bin) + '.frag'
-            hmm_output = os.path.join(output_bin_path, bin) + '.hmmout'
-            seed_output = os.path.join(output_bin_path, bin) + '.seed'
+        if pending:
+            scan_fasta, scan_dir, scan_key = args.contig_fasta, os.path.join(out, 'markers'), markers_key
+            if len(pending) < len(written_bins):
+                # the hits of a contig do not depend on the other contigs
+                # scanned, so only the contigs of the bins not cached are; they
+                # keep their assembly order, which the seed selection depends on
+                pending_set = {namelist[i] for label in pending for i in members[label]}
+                pending_contigs = [name for name in fasta.names if name in pending_set]
+                scan_dir = os.path.join(out, 'markers', 'pending')
+                scan_fasta = os.path.join(scan_dir, 'contigs.fa')
+                scan_key = input_hash('pending', markers_key, '\n'.join(pending_contigs))
+                os.makedirs(scan_dir, exist_ok=True)
+                with atomic_write(scan_fasta, mode='wb', overwrite=True) as ofile:
+                    fasta.write_records(ofile, pending_contigs)
             try:
-                cal_num_bins(os.path.join(output_bin_path, bin),contig_output,hmm_output,seed_output,binned_short)
-            except:
-                pass
-            contig_index = [mapObj[temp] for temp in contig_list]
-            re_bin_features = embedding_new[contig_index]
-            if not os.path.exists(os.path.join(out, 'output_recluster_bins')):
-                os.mkdir(os.path.join(out, 'output_recluster_bins'))
-
-            if os.path.exists(seed_output):
-                seed = open(seed_output).read().split('\n')
-                seed = [contig for contig in seed if contig != '']
-                init_seed = seed
-                num_bin = len(seed)
-                seed_index = []
-                for temp in init_seed:
-                    seed_index.append(row_index.index(temp))
-                length_weight = np.array([contig_length_dict[name] for name in contig_list])
-                seeds_embedding = embedding_new[seed_index]
-                kmeans = KMeans(n_clusters=num_bin, init=seeds_embedding,n_init=1)
-                kmeans.fit(re_bin_features, sample_weight=length_weight)
-                labels = kmeans.labels_
-                write_bins(contig_list, labels, os.path.join(out, 'output_recluster_bins'), contig_dict,
-                           recluster=True, origin_label=int(bin.split('.')[-2]))
+                # only whole assemblies are worth keeping in the cache
+                hmm_output = run_marker_scan(scan_fasta, scan_dir, args.threads,
+                                             timeout=args.tool_timeout, report=report,
+                                             cache=cache if scan_fasta == args.contig_fasta else None,
+                                             key=scan_key, force=args.force)
+            except ToolError as e:
+                logger.warning('Marker gene scan failed, bins are not reclustered: {}'.format(e))
+                seeds_complete = False
             else:
-                shutil.copy(os.path.join(output_bin_path, bin), os.path.join(out, 'output_recluster_bins'))
+                with report.timed('select_seeds', bins=len(pending)) as record:
+                    hits = parse_domtblout(hmm_output)
+                    contig_bin = {namelist[i]: label for label in pending for i in members[label]}
+                    new_seeds = select_seeds(hits, contig_bin, contig_length_dict, min_len)
+                    record['bins_with_seeds'] = len(new_seeds)
+                bin_seeds.update(new_seeds)
+                if cache is not None:
+                    for label in pending:
+                        cache.put_bin(bin_keys[label], new_seeds.get(label, []))
+        if cache is not None:
+            cache.close()
+            logger.info('Marker cache: {}'.format(cache.report()))
+            report.add({'name': 'marker_cache', 'status': 'ok', 'hits': cache.hits,
+                        'misses': cache.misses, 'evicted': cache.evicted})
+        if seeds_complete:
+            seed_labels = [label for label in bin_seeds for _ in bin_seeds[label]]
+            checkpoints.save('seeds', seeds_key,
+                             labels=np.array(seed_labels, dtype=np.int64),
+                             contigs=np.array([contig for label in bin_seeds for contig in bin_seeds[label]], dtype=str))
+
+    # a run without seeds (failed marker scan) is not checkpointed, so that it is retried
+    recluster_key = input_hash('recluster', seeds_key, args.recluster_engine, args.minibatch_threshold,
+                               args.recluster_compare)
+    if seeds_complete and checkpoints.load('recluster', recluster_key) is not None:
+        return
+    shutil.rmtree(recluster_path, ignore_errors=True)
+    os.makedirs(recluster_path)
+
+    # the largest bins are started first so that no straggler is left at the end
+    bin_bp = {label: contig_length[members[label]].sum() for label in written_bins}
+    schedule = sorted(written_bins, key=lambda label: -bin_bp[label])
+    n_workers = max(1, min(args.recluster_workers, args.threads, len(schedule)))
+    state = {
+        'namelist': namelist,
+        'members': members,
+        'embedding': embedding_new,
+        'contig_length': contig_length,
+        'mapObj': mapObj,
+        'fasta': fasta,
+        'output_bin_path': output_bin_path,
+        'recluster_path': recluster_path,
+        'threads': max(1, args.threads // n_workers),
+        'multifasta': multifasta,
+        'engine': args.recluster_engine,
+        'minibatch_threshold': args.minibatch_threshold,
+        'compare': args.recluster_compare,
+    }
+    with report.timed('recluster', bins=len(schedule), workers=n_workers) as summary:
+        if n_workers == 1:
+            init_recluster(state)
+            results = [recluster_bin(label, bin_seeds.get(label)) for label in schedule]
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers,
+                                     mp_context=multiprocessing.get_context('fork'),
+                                     initializer=init_recluster,
+                                     initargs=(state,)) as executor:
+                futures = [executor.submit(recluster_bin, label, bin_seeds.get(label)) for label in schedule]
+                results = [future.result() for future in futures]
+        records = [record for _, record in results if record is not None]
+        summary['minibatch_bins'] = sum(record['engine'] == 'minibatch' for record in records)
+
+    if args.recluster_compare:
+        fits = pd.DataFrame(records, columns=['bin', 'contigs', 'clusters', 'engine', 'inertia', 'wall_time',
+                                              'full_inertia', 'full_wall_time'])
+        fits.sort_values('bin').to_csv(os.path.join(out, 'recluster_inertia.tsv'), sep='\t', index=False)
+        compared = fits[fits['full_inertia'].notna()]
+        if len(compared):
+            logger.info('Mini-batch KMeans on {} bins: inertia {:.4f}x that of full KMeans, in {:.2f}x the time.'.format(
+                len(compared),
+                compared['inertia'].sum() / compared['full_inertia'].sum(),
+                compared['wall_time'].sum() / compared['full_wall_time'].sum()))
+
+    if multifasta:
+        # bins are stored in label order, whatever the schedule was
+        collected = {label: bins for label, (bins, _) in zip(schedule, results)}
+        with MultiFastaWriter(recluster_path, fasta, compress) as writer:
+            for label in written_bins:
+                for name, contigs in collected[label]:
+                    writer.add_bin(name, contigs)
+    if seeds_complete:
+        checkpoints.save('recluster', recluster_key, bins=np.array(written_bins, dtype=np.int64))
 
 if __name__ == '__main__':
     warnings.filterwarnings('ignore')
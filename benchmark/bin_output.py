@@ -0,0 +1,153 @@
+"""
+Bins of a run stored as a single multi-FASTA instead of one file per bin.
+
+An output directory then holds:
+
+    bins.tsv             contig -> bin assignment (contig<TAB>bin)
+    bins.fa / bins.fa.gz the records of all bins, grouped by bin (bgzip-compressed
+                         for .gz, so that it stays randomly accessible)
+    bins.idx             per bin: number of contigs, bp, and the offset and size of
+                         its records (offsets in the uncompressed stream, plus the
+                         BGZF virtual offset for bins.fa.gz)
+    bins.fa.fai          samtools index of an uncompressed bins.fa
+
+Bin names are the names of the per-bin files without `.fa` (`bin.3`,
+`recluster_3.bin.1`), and `python bin_output.py <dir>` writes these files back.
+"""
+import argparse
+import os
+import pandas as pd
+from fasta_utils import FAI_COLUMNS
+
+
+INDEX_COLUMNS = ['bin', 'contigs', 'bp', 'offset', 'size', 'voffset']
+
+
+class BinList(list):
+    """
+    Collects (bin name, contigs) pairs, e.g. in worker processes, so that the
+    parent can add them to a MultiFastaWriter
+    """
+    def add_bin(self, name, contigs):
+        self.append((name, list(contigs)))
+
+
+class MultiFastaWriter(object):
+    """
+    Writes bins one after the other to the multi-FASTA of `output_dir`,
+    copying the records from `fasta` (fasta_utils.IndexedFasta)
+    """
+    def __init__(self, output_dir, fasta, compress=False):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.fasta = fasta
+        self.compress = compress
+        self.path = os.path.join(output_dir, 'bins.fa.gz' if compress else 'bins.fa')
+        if compress:
+            from Bio import bgzf
+            self._out = bgzf.BgzfWriter(self.path + '.tmp', 'wb')
+        else:
+            self._out = open(self.path + '.tmp', 'wb', buffering=1024 * 1024)
+        self._pos = 0
+        self.assignments = []
+        self.index = []
+        self.fai = []
+
+    def _write(self, data):
+        self._out.write(data)
+        self._pos += len(data)
+
+    def add_bin(self, name, contigs):
+        start = self._pos
+        voffset = self._out.tell() if self.compress else start
+        bp = 0
+        for contig in contigs:
+            i = self.fasta.index[contig]
+            self._write(b'>' + contig.encode() + b'\n')
+            lines = self.fasta.raw(contig)
+            length = int(self.fasta.lengths[i])
+            self.fai.append((contig, length, self._pos,
+                             int(self.fasta.linebases[i]), int(self.fasta.linewidths[i])))
+            self._write(lines)
+            if len(lines) and lines[-1] != ord('\n'):
+                self._write(b'\n')
+            self.assignments.append((contig, name))
+            bp += length
+        self.index.append((name, len(contigs), bp, start, self._pos - start, voffset))
+
+    def close(self):
+        self._out.close()
+        os.replace(self.path + '.tmp', self.path)
+        pd.DataFrame(self.assignments, columns=['contig', 'bin']).to_csv(
+            os.path.join(self.output_dir, 'bins.tsv'), sep='\t', index=False)
+        pd.DataFrame(self.index, columns=INDEX_COLUMNS).to_csv(
+            os.path.join(self.output_dir, 'bins.idx'), sep='\t', index=False)
+        fai_file = self.path + '.fai'
+        if not self.compress:
+            pd.DataFrame(self.fai, columns=FAI_COLUMNS).to_csv(fai_file, sep='\t', header=False, index=False)
+        elif os.path.exists(fai_file):
+            os.remove(fai_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_assignments(output_dir):
+    """
+    Returns the contig -> bin table of an output directory as a DataFrame
+    """
+    return pd.read_csv(os.path.join(output_dir, 'bins.tsv'), sep='\t', dtype=str)
+
+
+def read_index(output_dir):
+    return pd.read_csv(os.path.join(output_dir, 'bins.idx'), sep='\t',
+                       dtype={'bin': str}).set_index('bin')
+
+
+def extract_bins(output_dir, names=None):
+    """
+    Yields (bin name, records as bytes) for the given bins (default: all)
+    """
+    index = read_index(output_dir)
+    if names is None:
+        names = index.index
+    compressed = os.path.exists(os.path.join(output_dir, 'bins.fa.gz'))
+    if compressed:
+        from Bio import bgzf
+        f = bgzf.BgzfReader(os.path.join(output_dir, 'bins.fa.gz'), 'rb')
+    else:
+        f = open(os.path.join(output_dir, 'bins.fa'), 'rb')
+    with f:
+        for name in names:
+            entry = index.loc[name]
+            f.seek(int(entry['voffset'] if compressed else entry['offset']))
+            yield name, f.read(int(entry['size']))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Write per-bin fasta files from a multi-FASTA bin output directory')
+    parser.add_argument('input_dir',
+                        help='Directory with bins.tsv, bins.idx and bins.fa or bins.fa.gz.')
+    parser.add_argument('-b', '--bin',
+                        help='Bin to extract (can be repeated; default: all bins).',
+                        dest='bins',
+                        action='append',
+                        default=None)
+    parser.add_argument('-o', '--output',
+                        help='Directory for the <bin>.fa files (default: the input directory).',
+                        dest='output',
+                        default=None)
+    args = parser.parse_args()
+    output = args.input_dir if args.output is None else args.output
+    os.makedirs(output, exist_ok=True)
+    for name, records in extract_bins(args.input_dir, args.bins):
+        with open(os.path.join(output, name + '.fa'), 'wb') as out:
+            out.write(records)
+
+
+if __name__ == '__main__':
+    main()
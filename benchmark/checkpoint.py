@@ -0,0 +1,100 @@
+"""
+Stage checkpoints for SemiBin_generalization.py.
+
+Every stage saves its result to `<output>/checkpoints/<stage>.npz` together
+with a key hashed from the stage inputs (arrays, parameters and the key of the
+previous stage). A rerun loads the result of a stage when the keys match, so
+that a run that failed late does not repeat the kNN graph and the clustering.
+"""
+import os
+import hashlib
+import logging
+import numpy as np
+
+
+HASH_ROWS = 65536
+
+
+def _update(h, part):
+    if isinstance(part, np.ndarray):
+        h.update('array:{}:{}:'.format(part.dtype.str, part.shape).encode())
+        if part.ndim == 0:
+            h.update(part.tobytes())
+        else:
+            for start in range(0, len(part), HASH_ROWS):
+                h.update(np.ascontiguousarray(part[start:start + HASH_ROWS]).tobytes())
+    elif isinstance(part, (list, tuple)):
+        h.update('list:{}:'.format(len(part)).encode())
+        for item in part:
+            _update(h, item)
+    elif isinstance(part, dict):
+        h.update('dict:{}:'.format(len(part)).encode())
+        for key in sorted(part):
+            _update(h, key)
+            _update(h, part[key])
+    elif isinstance(part, bytes):
+        h.update(b'bytes:' + part)
+    elif isinstance(part, str):
+        h.update(b'str:' + part.encode())
+    else:
+        h.update('{}:{!r}'.format(type(part).__name__, part).encode())
+    h.update(b'\0')
+
+
+def input_hash(*parts):
+    """
+    Hash of the given arrays, parameters and nested lists/dicts of them
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        _update(h, part)
+    return h.hexdigest()
+
+
+def file_hash(path):
+    """
+    Content hash of a file, or None when it does not exist
+    """
+    if not os.path.exists(path):
+        return None
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class Checkpoints(object):
+    """
+    Loads and saves the stage results of one output directory
+
+    With `force`, no checkpoint is loaded (they are still saved).
+    """
+    def __init__(self, output, force=False, logger=None):
+        self.directory = os.path.join(output, 'checkpoints')
+        os.makedirs(self.directory, exist_ok=True)
+        self.force = force
+        self.logger = logger if logger is not None else logging.getLogger('SemiBin')
+
+    def path(self, stage):
+        return os.path.join(self.directory, '{}.npz'.format(stage))
+
+    def load(self, stage, key):
+        """
+        Returns the arrays saved for `stage` under `key`, or None
+        """
+        path = self.path(stage)
+        if self.force or not os.path.exists(path):
+            return None
+        with np.load(path, allow_pickle=False) as data:
+            if str(data['_key']) != key:
+                return None
+            arrays = {name: data[name] for name in data.files if name != '_key'}
+        self.logger.info('Stage {}: loaded from checkpoint.'.format(stage))
+        return arrays
+
+    def save(self, stage, key, **arrays):
+        path = self.path(stage)
+        with open(path + '.tmp', 'wb') as out:
+            np.savez(out, _key=np.array(key), **arrays)
+        os.replace(path + '.tmp', path)
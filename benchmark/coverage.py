@@ -0,0 +1,315 @@
+"""
+Aggregate `bedtools genomecov` histograms into a contig coverage table.
+
+This replaces the gen_cov.sh + Collate.pl + `perl -pe "s/,/\t/g;"` pipeline:
+every `<sample>_cov.txt` in the input directory is streamed in large chunks,
+the length-weighted mean depth of each contig is accumulated with NumPy and
+the samples are merged into the `coverage.tsv` read by SolidBin and COCACOLA.
+
+The same pass can also produce per-contig depth mean and variance, in the
+column layout of data.csv used by SemiBin_generalization.py.
+"""
+import argparse
+import os
+import re
+import glob
+import numpy as np
+import pandas as pd
+from functools import partial
+from multiprocessing import Pool
+from fasta_utils import load_fai
+
+
+CHUNKSIZE = 4 * 1024 * 1024
+
+
+def is_bedgraph(cov_file):
+    """
+    `genomecov -bga` output has 4 columns, the histogram output has 5
+    """
+    with open(cov_file) as f:
+        line = f.readline()
+    return len(line.rstrip('\n').split('\t')) == 4
+
+
+def genomecov_sums(cov_file, contig_len=None, edge=0, chunksize=CHUNKSIZE):
+    """
+    Stream a `bedtools genomecov` output and accumulate, per contig, the
+    number of bases (W), the depth sum (S1) and the squared depth sum (S2)
+
+    Both the histogram output and the `-bga` bedgraph output are accepted.
+    For bedgraph input, `edge` bases at either end of every contig longer
+    than 2 * edge are left out; this needs `contig_len` (name -> length).
+
+    Returns (contigs, W, S1, S2, length)
+    """
+    bedgraph = is_bedgraph(cov_file)
+    if edge and not bedgraph:
+        raise ValueError('Trimming contig edges needs `genomecov -bga` input ({})'.format(cov_file))
+    if edge and contig_len is None:
+        raise ValueError('Trimming contig edges needs the contig lengths')
+    if bedgraph:
+        names = ['contig', 'start', 'end', 'depth']
+    else:
+        names = ['contig', 'depth', 'count', 'length']
+
+    index = {}
+    sums = np.zeros((4, 0))
+    for chunk in pd.read_csv(cov_file, sep='\t', header=None, usecols=range(4),
+                             names=names, dtype={'contig': str},
+                             chunksize=chunksize):
+        codes, contigs = pd.factorize(chunk['contig'])
+        ids = np.array([index.setdefault(c, len(index)) for c in contigs], dtype=np.int64)
+        if len(index) > sums.shape[1]:
+            sums = np.concatenate([sums, np.zeros((4, len(index) - sums.shape[1]))], axis=1)
+        depth = chunk['depth'].values.astype(np.float64)
+        if bedgraph:
+            start = chunk['start'].values
+            end = chunk['end'].values
+            if edge:
+                length = np.array([contig_len[c] for c in contigs])[codes]
+                trim = length > 2 * edge
+                start = np.where(trim, np.maximum(start, edge), start)
+                end = np.where(trim, np.minimum(end, length - edge), end)
+                sums[3, ids[codes]] = length
+            else:
+                np.maximum.at(sums[3], ids[codes], end)
+            weight = np.maximum(end - start, 0)
+        else:
+            weight = chunk['count'].values
+            sums[3, ids[codes]] = chunk['length'].values
+        n = len(contigs)
+        sums[0, ids] += np.bincount(codes, weights=weight, minlength=n)
+        sums[1, ids] += np.bincount(codes, weights=weight * depth, minlength=n)
+        sums[2, ids] += np.bincount(codes, weights=weight * depth * depth, minlength=n)
+    return list(index), sums[0], sums[1], sums[2], sums[3]
+
+
+def genomecov_depth(cov_file, chunksize=CHUNKSIZE):
+    """
+    Mean depth of every contig from a `bedtools genomecov` histogram
+
+    Returns a Series indexed by contig (the `genome` summary rows are kept,
+    as gen_cov.sh does)
+    """
+    contigs, _, depth_sum, _, contig_len = genomecov_sums(cov_file, chunksize=chunksize)
+    return pd.Series(depth_sum / contig_len, index=contigs)
+
+
+def genomecov_mean_var(cov_file, contig_len=None, edge=0, chunksize=CHUNKSIZE):
+    """
+    Per-contig depth mean and (population) variance computed in one pass
+
+    Returns a DataFrame indexed by contig with columns `mean` and `var`
+    """
+    contigs, weight, depth_sum, depth_sq_sum, _ = genomecov_sums(cov_file, contig_len, edge, chunksize)
+    weight = np.maximum(weight, 1)
+    mean = depth_sum / weight
+    var = np.maximum(depth_sq_sum / weight - mean * mean, 0)
+    result = pd.DataFrame({'mean': mean, 'var': var}, index=contigs)
+    return result.drop('genome', errors='ignore')
+
+
+def contig_sort_key(contig):
+    """
+    Collate.pl orders contigs by the number after their last `_`
+    """
+    match = re.match(r'.*_(\d+)', contig)
+    return (int(match.group(1)) if match else 0, contig)
+
+
+def format_value(value):
+    """
+    Format a number the way awk prints it
+    """
+    if value == int(value) and abs(value) < 1e16:
+        return str(int(value))
+    return '{:.6g}'.format(value)
+
+
+def contig_order(contigs):
+    """
+    Index of the contigs in Collate.pl output order (without `genome`)
+    """
+    contigs = [c for c in contigs if c != 'genome']
+    return pd.Index(sorted(contigs, key=contig_sort_key))
+
+
+def fill_row(matrix, row, contig_index, contigs, values):
+    idx = contig_index.get_indexer(contigs)
+    found = idx >= 0
+    matrix[row, idx[found]] = values[found]
+
+
+def drop_uncovered(contig_index, matrix):
+    """
+    Drop contigs with no coverage in any sample, as Collate.pl does
+    """
+    covered = matrix.sum(axis=0, dtype=np.float64) > 0
+    return contig_index[covered], matrix[:, covered]
+
+
+def read_cov_csv(cov_csv, chunksize=CHUNKSIZE):
+    """
+    Stream a gen_cov.sh `<sample>_cov.csv` (contig,depth) file
+    """
+    for chunk in pd.read_csv(cov_csv, header=None, names=['contig', 'depth'],
+                             dtype={'contig': str}, chunksize=chunksize):
+        yield chunk['contig'].values, chunk['depth'].values
+
+
+def write_tsv(contigs, samples, matrix, output):
+    with open(output, 'w') as out:
+        out.write('contig\t{}\n'.format('\t'.join(samples)))
+        for j, contig in enumerate(contigs):
+            out.write('{}\t{}\n'.format(contig, '\t'.join(format_value(float(v)) for v in matrix[:, j])))
+
+
+def write_binary(contigs, samples, matrix, output):
+    np.savez(output,
+             contigs=np.array(contigs, dtype=str),
+             samples=np.array(samples, dtype=str),
+             depth=matrix.astype(np.float32))
+
+
+def sample_names(cov_files, suffix):
+    # Sample names are the file paths without the suffix, as in Collate.pl
+    return [f[:-len(suffix)] for f in cov_files]
+
+
+def parallel_imap(fn, items, threads):
+    if threads > 1 and len(items) > 1:
+        with Pool(min(threads, len(items))) as pool:
+            for result in pool.imap(fn, items):
+                yield result
+    else:
+        for item in items:
+            yield fn(item)
+
+
+def parallel_map(fn, items, threads):
+    return list(parallel_imap(fn, items, threads))
+
+
+def generate_coverage(cov_dir, output=None, binary=None, threads=1, contig_fasta=None, collate=False):
+    """
+    Merge the samples of `cov_dir` into a samples x contigs matrix
+
+    The matrix is float64, so that coverage.tsv prints the same digits as
+    the awk/Collate.pl pipeline; only the `binary` copy is stored as float32.
+
+    The contig order is resolved once, from the .fai index of `contig_fasta`
+    when given and otherwise from the union of contigs in the inputs, and
+    every sample fills its row while its file is streamed. With `collate`,
+    the inputs are the `<sample>_cov.csv` files of gen_cov.sh instead of the
+    genomecov outputs.
+    """
+    suffix = '_cov.csv' if collate else '_cov.txt'
+    cov_files = sorted(glob.glob(os.path.join(cov_dir, '*' + suffix)))
+    samples = sample_names(cov_files, suffix)
+
+    if contig_fasta is not None:
+        contig_index = contig_order(load_fai(contig_fasta)['name'].values)
+        depths = None
+    elif collate:
+        contigs = set()
+        for f in cov_files:
+            for chunk_contigs, _ in read_cov_csv(f):
+                contigs.update(chunk_contigs)
+        contig_index = contig_order(contigs)
+        depths = None
+    else:
+        depths = parallel_map(genomecov_depth, cov_files, threads)
+        contig_index = contig_order(set().union(*[d.index for d in depths]))
+
+    matrix = np.zeros((len(cov_files), len(contig_index)), dtype=np.float64)
+    if collate:
+        for row, f in enumerate(cov_files):
+            for chunk_contigs, values in read_cov_csv(f):
+                fill_row(matrix, row, contig_index, chunk_contigs, values)
+    else:
+        if depths is None:
+            depths = parallel_imap(genomecov_depth, cov_files, threads)
+        for row, depth in enumerate(depths):
+            fill_row(matrix, row, contig_index, depth.index, depth.values)
+    contig_index, matrix = drop_uncovered(contig_index, matrix)
+
+    if output is not None:
+        write_tsv(contig_index, samples, matrix, output)
+    if binary is not None:
+        write_binary(contig_index, samples, matrix, binary)
+    return contig_index, samples, matrix
+
+
+def generate_depth(cov_dir, output, contig_fasta=None, edge=0, threads=1):
+    """
+    Write the per-sample depth mean/variance in the layout of the depth
+    columns of data.csv (`<sample>_mean`, `<sample>_var` for each sample)
+    """
+    contig_len = None
+    order = None
+    if contig_fasta is not None:
+        fai = load_fai(contig_fasta)
+        contig_len = dict(zip(fai['name'].values, fai['length'].values))
+        order = fai['name'].values
+    cov_files = sorted(glob.glob(os.path.join(cov_dir, '*_cov.txt')))
+    results = parallel_map(partial(genomecov_mean_var, contig_len=contig_len, edge=edge),
+                           cov_files, threads)
+    columns = []
+    for name, result in zip(sample_names(cov_files, '_cov.txt'), results):
+        name = os.path.basename(name)
+        columns.append(result['mean'].rename('{}_mean'.format(name)))
+        columns.append(result['var'].rename('{}_var'.format(name)))
+    depth = pd.concat(columns, axis=1, sort=False).fillna(0.)
+    if order is not None:
+        depth = depth.reindex(order, fill_value=0.)
+    depth.to_csv(output)
+    return depth
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate coverage profiles from bedtools genomecov histograms')
+    parser.add_argument('input_dir',
+                        help='Directory with the <sample>_cov.txt genomecov outputs.')
+    parser.add_argument('-o', '--output',
+                        help='Output coverage table (tab-separated).',
+                        dest='output',
+                        default=None)
+    parser.add_argument('--binary',
+                        help='Also save the samples x contigs float32 matrix as .npz to this path.',
+                        dest='binary',
+                        default=None)
+    parser.add_argument('--depth-csv',
+                        help='Also save per-contig depth mean and variance (data.csv column layout) to this path.',
+                        dest='depth_csv',
+                        default=None)
+    parser.add_argument('--collate',
+                        help='Merge the <sample>_cov.csv files of gen_cov.sh instead (replaces Collate.pl).',
+                        action='store_true',
+                        dest='collate')
+    parser.add_argument('-i', '--contig-fasta',
+                        help='Contig fasta file; its index fixes the contig set and gives the lengths for --depth-csv.',
+                        dest='contig_fasta',
+                        default=None)
+    parser.add_argument('--edge',
+                        type=int,
+                        help='Bases trimmed at each contig end for --depth-csv (needs `genomecov -bga` input and --contig-fasta).',
+                        dest='edge',
+                        default=0)
+    parser.add_argument('-t', '--threads',
+                        type=int,
+                        help='Number of samples processed in parallel.',
+                        dest='threads',
+                        default=1)
+
+    args = parser.parse_args()
+    if args.output is not None or args.binary is not None:
+        generate_coverage(args.input_dir, args.output, args.binary, args.threads,
+                          args.contig_fasta, args.collate)
+    if args.depth_csv is not None:
+        generate_depth(args.input_dir, args.depth_csv, args.contig_fasta, args.edge, args.threads)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Size-bounded on-disk cache shared across benchmark runs.
+
+Entries are stored in a single SQLite file inside the cache directory and are
+evicted in least-recently-used order once the stored payload exceeds
+``max_bytes``.
+"""
+import os
+import sqlite3
+import time
+import hashlib
+import numpy as np
+
+
+DEFAULT_MAX_BYTES = 4 * 1024 ** 3
+
+
+class DiskCache(object):
+    """
+    A key -> bytes store with LRU eviction and hit/miss accounting.
+
+    Updates are batched in a transaction and written out by ``flush()``
+    (called automatically by ``close()`` and when used as a context manager).
+    """
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES, name='cache'):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, '{}.sqlite'.format(name))
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._touched = []
+        self._conn = sqlite3.connect(self.path, timeout=600)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS entries '
+            '(key TEXT PRIMARY KEY, value BLOB, size INTEGER, atime INTEGER)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime)')
+
+    def get(self, key):
+        row = self._conn.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touched.append((time.time_ns(), key))
+        return row[0]
+
+    def put(self, key, value):
+        self._conn.execute(
+            'INSERT OR REPLACE INTO entries (key, value, size, atime) VALUES (?, ?, ?, ?)',
+            (key, value, len(value), time.time_ns()))
+
+    def flush(self):
+        if self._touched:
+            self._conn.executemany('UPDATE entries SET atime = ? WHERE key = ?', self._touched)
+            self._touched = []
+        self._evict()
+        self._conn.commit()
+
+    def _evict(self):
+        total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        cursor = self._conn.execute('SELECT key, size FROM entries ORDER BY atime')
+        evict = []
+        for key, size in cursor:
+            if total <= self.max_bytes:
+                break
+            evict.append((key,))
+            total -= size
+        self._conn.executemany('DELETE FROM entries WHERE key = ?', evict)
+        self.evicted += len(evict)
+
+    def report(self):
+        lookups = self.hits + self.misses
+        rate = 100. * self.hits / lookups if lookups else 0.
+        return '{} hits, {} misses ({:.1f}% hit rate), {} evicted'.format(
+            self.hits, self.misses, rate, self.evicted)
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class KmerCache(DiskCache):
+    """
+    Cache of k-mer composition vectors keyed by a hash of the contig sequence and k.
+    """
+    def __init__(self, cache_dir, kmer_len, max_bytes=DEFAULT_MAX_BYTES):
+        super(KmerCache, self).__init__(cache_dir, max_bytes, name='kmer')
+        self.kmer_len = kmer_len
+
+    def _key(self, seq):
+        h = hashlib.sha1(str(self.kmer_len).encode())
+        h.update(b':')
+        h.update(seq)
+        return h.hexdigest()
+
+    def get_vector(self, seq):
+        """
+        seq: upper-case sequence as bytes
+
+        Returns the stored composition vector or None
+        """
+        value = self.get(self._key(seq))
+        if value is None:
+            return None
+        return np.frombuffer(value, dtype=np.int64)
+
+    def put_vector(self, seq, composition_v):
+        self.put(self._key(seq), np.asarray(composition_v, dtype=np.int64).tobytes())
@@ -0,0 +1,257 @@
+"""
+Streaming FASTA reading shared by the benchmark scripts.
+
+Records are parsed at the byte level without building Biopython objects.
+Contig ids follow the SeqIO convention: the header up to the first whitespace.
+
+A samtools-compatible ``.fai`` index (name, length, offset, line bases, line
+width) is built once next to the FASTA and reused by later runs;
+`IndexedFasta` uses it to copy records straight out of the mapped file.
+"""
+import os
+import gzip
+import mmap
+from collections.abc import Mapping
+import numpy as np
+import pandas as pd
+
+
+FAI_COLUMNS = ['name', 'length', 'offset', 'linebases', 'linewidth']
+
+
+def is_gzipped(fasta_file):
+    with open(fasta_file, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+def open_fasta(fasta_file):
+    """
+    Open a (possibly gzip-compressed) FASTA file for binary reading
+    """
+    if is_gzipped(fasta_file):
+        return gzip.open(fasta_file, 'rb')
+    return open(fasta_file, 'rb', buffering=1024 * 1024)
+
+
+def _parse_id(header):
+    fields = header[1:].split(None, 1)
+    return fields[0].decode() if fields else ''
+
+
+def iter_fasta(fasta_file):
+    """
+    Yields (id, sequence) for every record, with sequence as bytes
+    """
+    with open_fasta(fasta_file) as f:
+        name = None
+        chunks = []
+        for line in f:
+            if line.startswith(b'>'):
+                if name is not None:
+                    yield name, b''.join(chunks)
+                name = _parse_id(line)
+                chunks = []
+            elif name is not None:
+                chunks.append(line.strip())
+        if name is not None:
+            yield name, b''.join(chunks)
+
+
+def iter_fasta_lengths(fasta_file):
+    """
+    Yields (id, length) for every record without keeping the sequences
+    """
+    with open_fasta(fasta_file) as f:
+        name = None
+        length = 0
+        for line in f:
+            if line.startswith(b'>'):
+                if name is not None:
+                    yield name, length
+                name = _parse_id(line)
+                length = 0
+            elif name is not None:
+                length += len(line.strip())
+        if name is not None:
+            yield name, length
+
+
+def build_fai(fasta_file):
+    """
+    Scan the FASTA once and return its index as a DataFrame with FAI_COLUMNS
+
+    As with `samtools faidx`, all the sequence lines of a record but the last
+    must have the same width (the index could not locate the bases
+    otherwise); a ValueError is raised for irregular records.
+
+    For gzip input, offsets refer to the decompressed stream.
+    """
+    names = []
+    lengths = []
+    offsets = []
+    linebases = []
+    linewidths = []
+    with open_fasta(fasta_file) as f:
+        pos = 0
+        # set once a record had a line shorter than its first: no more sequence may follow
+        last_line = False
+        for line in f:
+            pos += len(line)
+            if line.startswith(b'>'):
+                names.append(_parse_id(line))
+                lengths.append(0)
+                offsets.append(pos)
+                linebases.append(0)
+                linewidths.append(0)
+                last_line = False
+            elif names:
+                n = len(line.rstrip(b'\r\n'))
+                if n and (last_line or n > (linebases[-1] or n)):
+                    raise ValueError('Different line length in sequence {} of {}'.format(names[-1], fasta_file))
+                if not linebases[-1] and n:
+                    linebases[-1] = n
+                    linewidths[-1] = len(line)
+                elif n != linebases[-1] or len(line) != linewidths[-1]:
+                    last_line = True
+                lengths[-1] += n
+    return pd.DataFrame({
+        'name': names,
+        'length': np.array(lengths, dtype=np.int64),
+        'offset': np.array(offsets, dtype=np.int64),
+        'linebases': np.array(linebases, dtype=np.int64),
+        'linewidth': np.array(linewidths, dtype=np.int64),
+        }, columns=FAI_COLUMNS)
+
+
+def load_fai(fasta_file):
+    """
+    Return the index of `fasta_file`, reading `fasta_file.fai` when it is
+    up-to-date and (re)building and saving it otherwise
+    """
+    fai_file = fasta_file + '.fai'
+    if os.path.exists(fai_file) and os.path.getmtime(fai_file) >= os.path.getmtime(fasta_file):
+        return pd.read_csv(fai_file, sep='\t', header=None, names=FAI_COLUMNS,
+                           dtype={'name': str}, usecols=range(5))
+    fai = build_fai(fasta_file)
+    try:
+        fai.to_csv(fai_file, sep='\t', header=False, index=False)
+    except OSError:
+        pass
+    return fai
+
+
+def record_span(offset, length, linebases, linewidth):
+    """
+    Byte range [start, end) of the sequence lines of a record, given its
+    .fai entry (the last line may have no newline at the end of the file)
+    """
+    if length == 0:
+        return offset, offset
+    full_lines, rest = divmod(length, linebases)
+    size = full_lines * linewidth
+    if rest:
+        size += rest + linewidth - linebases
+    return offset, offset + size
+
+
+class IndexedFasta(Mapping):
+    """
+    Random access to the records of a FASTA file through its .fai index
+
+    This is a read-only mapping id -> sequence (str) that reads sequences
+    lazily, so it can stand in for a dict of the whole assembly without
+    holding it in memory. Plain files are memory-mapped; gzip files are
+    decompressed into memory once (the offsets of their index refer to the
+    decompressed stream).
+    """
+    def __init__(self, fasta_file):
+        self.fasta_file = fasta_file
+        fai = load_fai(fasta_file)
+        self.names = [str(n) for n in fai['name'].values]
+        self.index = dict(zip(self.names, range(len(self.names))))
+        self.lengths = fai['length'].values
+        self.offsets = fai['offset'].values
+        self.linebases = fai['linebases'].values
+        self.linewidths = fai['linewidth'].values
+        if is_gzipped(fasta_file):
+            with gzip.open(fasta_file, 'rb') as f:
+                self.data = f.read()
+        else:
+            with open(fasta_file, 'rb') as f:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(fasta_file) else b''
+        self.view = memoryview(self.data)
+
+    def length(self, name):
+        return int(self.lengths[self.index[name]])
+
+    def raw(self, name):
+        """
+        Zero-copy view of the sequence lines of `name`, as laid out in the file
+        """
+        i = self.index[name]
+        start, end = record_span(self.offsets[i], self.lengths[i], self.linebases[i], self.linewidths[i])
+        return self.view[start:min(end, len(self.data))]
+
+    def __getitem__(self, name):
+        return b''.join(self.raw(name).tobytes().split()).decode()
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def write_records(self, out, names):
+        """
+        Write the records of `names` to the binary file object `out`, with
+        `>name` headers and the sequence lines copied from the source
+        """
+        for name in names:
+            out.write(b'>' + name.encode() + b'\n')
+            lines = self.raw(name)
+            out.write(lines)
+            if len(lines) and lines[-1] != ord('\n'):
+                out.write(b'\n')
+
+    def close(self):
+        self.view.release()
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def get_threshold(contig_len):
+    """
+    calculate the threshold length for must link breaking up
+
+    (the shortest length needed to reach 98% of the assembly bp in contigs
+    sorted by decreasing length, but at least 4000)
+    """
+    contig_len = np.sort(np.asarray(contig_len, dtype=np.int64))[::-1]
+    cumulative = np.cumsum(contig_len)
+    index = np.searchsorted(cumulative / cumulative[-1], 0.98)
+    return max(int(contig_len[min(index, len(contig_len) - 1)]), 4000)
+
+
+def short_contig_fraction(contig_len):
+    """
+    fraction of the assembly bp in contigs of 1000-2500 bp
+    """
+    contig_len = np.asarray(contig_len, dtype=np.int64)
+    short = (contig_len >= 1000) & (contig_len <= 2500)
+    return contig_len[short].sum() / contig_len.sum()
+
+
+def is_binned_short(contig_len):
+    """
+    whether contigs of 1000-2500 bp are binned (they make up <5% of the bp)
+    """
+    return short_contig_fraction(contig_len) < 0.05
@@ -0,0 +1,273 @@
+"""
+Per-sample feature store: one memory-mappable file holding every contig
+feature used by the benchmark (SemiBin k-mer and depth columns from data.csv,
+gen_kmer.py k-mer counts, coverage.tsv depths and contig lengths).
+
+File layout:
+
+    magic (8 bytes) | header length (uint64, little-endian) | JSON header |
+    contig names ('\n'-separated UTF-8) | padding | float32 matrix
+
+The matrix is contigs x columns in C order; the header records the named
+column blocks (in order), their column labels and the byte offsets. Rows that
+are absent from a block's source (e.g. contigs shorter than the k-mer cut-off)
+are stored as NaN and skipped by the exporters.
+"""
+import argparse
+import json
+import os
+import struct
+import numpy as np
+import pandas as pd
+from fasta_utils import load_fai
+
+
+MAGIC = b'SBFEAT01'
+ALIGNMENT = 64
+# blocks in this order keep the data.csv columns (kmer, depth) adjacent
+BLOCK_ORDER = ['kmer', 'depth', 'length', 'kmer_counts', 'coverage']
+
+
+class FeatureStore(object):
+    """
+    Read-only, memory-mapped view of a feature store file
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('{} is not a feature store file'.format(path))
+            header_len, = struct.unpack('<Q', f.read(8))
+            self.header = json.loads(f.read(header_len).decode())
+            f.seek(self.header['names_offset'])
+            names = f.read(self.header['names_size']).decode()
+        self.names = names.split('\n') if names else []
+        self.blocks = {}
+        start = 0
+        for block in self.header['blocks']:
+            self.blocks[block['name']] = slice(start, start + len(block['columns']))
+            start += len(block['columns'])
+        self.matrix = np.memmap(path, dtype=np.float32, mode='r',
+                                offset=self.header['data_offset'],
+                                shape=(len(self.names), start))
+
+    def columns(self, name):
+        for block in self.header['blocks']:
+            if block['name'] == name:
+                return block['columns']
+        raise KeyError(name)
+
+    def block(self, name):
+        """
+        Zero-copy view of one column block
+        """
+        return self.matrix[:, self.blocks[name]]
+
+    def view(self, names):
+        """
+        View of several blocks; zero-copy when they are adjacent in the file
+        """
+        slices = [self.blocks[name] for name in names]
+        if all(a.stop == b.start for a, b in zip(slices, slices[1:])):
+            return self.matrix[:, slices[0].start:slices[-1].stop]
+        return np.concatenate([self.matrix[:, s] for s in slices], axis=1)
+
+    def frame(self, names):
+        """
+        DataFrame of the given blocks, without the rows absent from them
+        """
+        values = self.view(names)
+        present = ~np.all(np.isnan(values), axis=1)
+        columns = sum([self.columns(name) for name in names], [])
+        return pd.DataFrame(np.asarray(values[present]),
+                            index=np.array(self.names, dtype=object)[present],
+                            columns=columns)
+
+
+def write_feature_store(path, names, blocks, chunk_rows=65536):
+    """
+    names: contig names (row order)
+    blocks: list of (block name, DataFrame or 2-D array with len(names) rows)
+    """
+    names = list(names)
+    header_blocks = []
+    arrays = []
+    for name, values in blocks:
+        if isinstance(values, pd.DataFrame):
+            columns = [str(c) for c in values.columns]
+            values = values.values
+        else:
+            values = np.asarray(values)
+            if values.ndim == 1:
+                values = values.reshape(-1, 1)
+            columns = [str(c) for c in range(values.shape[1])]
+        if len(values) != len(names):
+            raise ValueError('Block {} has {} rows, expected {}'.format(name, len(values), len(names)))
+        header_blocks.append({'name': name, 'columns': columns})
+        arrays.append(values)
+
+    names_bytes = '\n'.join(names).encode()
+    header = {'n_contigs': len(names), 'dtype': '<f4', 'blocks': header_blocks}
+    # offsets depend on the header size, so fix them iteratively
+    header.update(names_offset=0, names_size=len(names_bytes), data_offset=0)
+    while True:
+        header_bytes = json.dumps(header).encode()
+        names_offset = len(MAGIC) + 8 + len(header_bytes)
+        data_offset = -(-(names_offset + len(names_bytes)) // ALIGNMENT) * ALIGNMENT
+        if header['names_offset'] == names_offset and header['data_offset'] == data_offset:
+            break
+        header['names_offset'] = names_offset
+        header['data_offset'] = data_offset
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as out:
+        out.write(MAGIC)
+        out.write(struct.pack('<Q', len(header_bytes)))
+        out.write(header_bytes)
+        out.write(names_bytes)
+        out.write(b'\0' * (data_offset - names_offset - len(names_bytes)))
+        for start in range(0, len(names), chunk_rows):
+            rows = [a[start:start + chunk_rows] for a in arrays]
+            out.write(np.ascontiguousarray(np.column_stack(rows), dtype='<f4').tobytes())
+    os.replace(tmp_path, path)
+
+
+def _frame_values(frame):
+    # feather files cannot store an index: the contig names are the first column
+    if isinstance(frame.index, pd.RangeIndex) and not pd.api.types.is_numeric_dtype(frame.dtypes.iloc[0]):
+        frame = frame.set_index(frame.columns[0])
+    return [str(n) for n in frame.index], frame.to_numpy(dtype=np.float32)
+
+
+def load_features(data_path, n_kmer=136):
+    """
+    Load the contig features used for binning (k-mer columns followed by the
+    depth columns) as a single float32 matrix
+
+    Accepted inputs are data.csv, a feature store file (.features), a .npy
+    matrix (contig names in `<name>.names.txt` next to it) and .parquet or
+    .feather tables. The first time a CSV file is read, a feature store copy
+    is cached next to it (`data.csv.features`) and used by later runs.
+
+    Returns (namelist, train_data)
+    """
+    if data_path.endswith('.features'):
+        store = FeatureStore(data_path)
+        return store.names, store.view(['kmer', 'depth'])
+    if data_path.endswith('.npy'):
+        with open(data_path[:-len('.npy')] + '.names.txt') as f:
+            names = f.read().split()
+        return names, np.load(data_path, mmap_mode='r').astype(np.float32, copy=False)
+    if data_path.endswith('.parquet'):
+        return _frame_values(pd.read_parquet(data_path))
+    if data_path.endswith('.feather'):
+        return _frame_values(pd.read_feather(data_path))
+
+    cache = data_path + '.features'
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(data_path):
+        store = FeatureStore(cache)
+        return store.names, store.view(['kmer', 'depth'])
+    header = pd.read_csv(data_path, index_col=0, nrows=0)
+    data = pd.read_csv(data_path, index_col=0, dtype={c: np.float32 for c in header.columns})
+    names = [str(n) for n in data.index]
+    train_data = data.to_numpy(dtype=np.float32)
+    try:
+        write_feature_store(cache, names, [
+            ('kmer', data.iloc[:, :n_kmer]),
+            ('depth', data.iloc[:, n_kmer:]),
+            ])
+    except OSError:
+        pass
+    return names, train_data
+
+
+def build_feature_store(output, data_csv=None, kmer_csv=None, coverage_tsv=None,
+                        contig_fasta=None, n_kmer=136):
+    """
+    Collect the legacy per-sample text outputs into one feature store
+
+    Rows follow data.csv when given (the contigs being binned), otherwise
+    the contig fasta index, otherwise the first input; rows of the other
+    inputs outside that set are not stored.
+    """
+    sources = []
+    if data_csv is not None:
+        data = pd.read_csv(data_csv, index_col=0).astype(np.float32)
+        sources.append(('kmer', data.iloc[:, :n_kmer]))
+        sources.append(('depth', data.iloc[:, n_kmer:]))
+    if contig_fasta is not None:
+        fai = load_fai(contig_fasta)
+        sources.append(('length', pd.DataFrame({'length': fai['length'].values}, index=fai['name'].values)))
+    if kmer_csv is not None:
+        sources.append(('kmer_counts', pd.read_csv(kmer_csv, index_col=0).astype(np.float32)))
+    if coverage_tsv is not None:
+        sources.append(('coverage', pd.read_csv(coverage_tsv, sep='\t', index_col=0).astype(np.float32)))
+    if not sources:
+        raise ValueError('No input to build the feature store from')
+
+    if data_csv is None and contig_fasta is not None:
+        names = fai['name'].values
+    else:
+        names = sources[0][1].index.values
+    sources.sort(key=lambda source: BLOCK_ORDER.index(source[0]))
+    blocks = [(name, frame.reindex(names)) for name, frame in sources]
+    write_feature_store(output, [str(n) for n in names], blocks)
+
+
+def export_data_csv(store, output):
+    store.frame(['kmer', 'depth']).to_csv(output)
+
+
+def export_kmer_csv(store, output):
+    store.frame(['kmer_counts']).to_csv(output)
+
+
+def export_coverage_tsv(store, output):
+    from coverage import write_tsv
+    frame = store.frame(['coverage'])
+    write_tsv(frame.index, frame.columns, frame.values.T, output)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build a per-sample feature store or export it to the legacy text formats')
+    subparsers = parser.add_subparsers(dest='command')
+
+    build = subparsers.add_parser('build', help='Build a feature store from the text outputs')
+    build.add_argument('-o', '--output', required=True, dest='output',
+                       help='Output feature store file.')
+    build.add_argument('--data-csv', dest='data_csv', default=None,
+                       help='SemiBin data.csv (k-mer and depth columns).')
+    build.add_argument('--kmer-csv', dest='kmer_csv', default=None,
+                       help='kmer.csv generated by gen_kmer.py.')
+    build.add_argument('--coverage-tsv', dest='coverage_tsv', default=None,
+                       help='coverage.tsv generated by coverage.py.')
+    build.add_argument('-i', '--contig-fasta', dest='contig_fasta', default=None,
+                       help='Contig fasta file (contig order and lengths).')
+    build.add_argument('--n-kmer', type=int, dest='n_kmer', default=136,
+                       help='Number of k-mer columns at the start of data.csv.')
+
+    export = subparsers.add_parser('export', help='Export a feature store to the text formats')
+    export.add_argument('store', help='Feature store file.')
+    export.add_argument('--data-csv', dest='data_csv', default=None)
+    export.add_argument('--kmer-csv', dest='kmer_csv', default=None)
+    export.add_argument('--coverage-tsv', dest='coverage_tsv', default=None)
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        build_feature_store(args.output, args.data_csv, args.kmer_csv, args.coverage_tsv,
+                            args.contig_fasta, args.n_kmer)
+    elif args.command == 'export':
+        store = FeatureStore(args.store)
+        if args.data_csv is not None:
+            export_data_csv(store, args.data_csv)
+        if args.kmer_csv is not None:
+            export_kmer_csv(store, args.kmer_csv)
+        if args.coverage_tsv is not None:
+            export_coverage_tsv(store, args.coverage_tsv)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
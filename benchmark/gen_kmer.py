@@ -4,12 +4,14 @@ import os
 import numpy as np
 import pandas as pd
 from itertools import product
-from Bio import SeqIO
 # optimized sliding window function from
 # http://stackoverflow.com/a/7636587
 from itertools import tee
 from collections import Counter, OrderedDict
 import pandas as p
+import sys
+from disk_cache import KmerCache
+from fasta_utils import iter_fasta
 
 
 def window(seq, n):
@@ -33,38 +35,50 @@ def generate_feature_mapping(kmer_len):
     return kmer_hash, counter
 
 
-def generate_features_from_fasta(fasta_file, length_threshold, kmer_len, outfile):
+def generate_features_from_fasta(fasta_file, length_threshold, kmer_len, outfile, cache_dir=None):
     kmer_dict, nr_features = generate_feature_mapping(kmer_len)
+    cache = KmerCache(cache_dir, kmer_len) if cache_dir is not None else None
 
     # Store composition vectors in a dictionary before creating dataframe
     composition_d = OrderedDict()
     contig_lengths = OrderedDict()
-    for seq in SeqIO.parse(fasta_file, "fasta"):
+    for seq_id, seq in iter_fasta(fasta_file):
         seq_len = len(seq)
         if seq_len <= length_threshold:
             continue
-        contig_lengths[seq.id] = seq_len
+        contig_lengths[seq_id] = seq_len
+        seq_upper = seq.upper()
+        if cache is not None:
+            composition_v = cache.get_vector(seq_upper)
+            if composition_v is not None:
+                composition_d[seq_id] = composition_v
+                continue
         # Create a list containing all kmers, translated to integers
         kmers = [
             kmer_dict[kmer_tuple]
             for kmer_tuple
-            in window(str(seq.seq).upper(), kmer_len)
+            in window(seq_upper.decode(), kmer_len)
             if kmer_tuple in kmer_dict
         ]
         kmers.append(nr_features - 1)
         composition_v = np.bincount(np.array(kmers, dtype=np.int64))
         composition_v[-1] -= 1
-        composition_d[seq.id] = composition_v
+        composition_d[seq_id] = composition_v
+        if cache is not None:
+            cache.put_vector(seq_upper, composition_v)
+    if cache is not None:
+        cache.close()
+        sys.stderr.write('k-mer cache: {}\n'.format(cache.report()))
     df = p.DataFrame.from_dict(composition_d, orient='index', dtype=float)
     df.to_csv(outfile)
 
 
 if __name__ == "__main__":
-    import sys
-
     fasta_file = sys.argv[1]
     length_threshold = int(sys.argv[2])
     kmer_len = int(sys.argv[3])
     output = sys.argv[4]
+    # optional: directory of the k-mer cache shared across runs
+    cache_dir = sys.argv[5] if len(sys.argv) > 5 else None
     outfile = os.path.join(output, 'kmer.csv')
-    generate_features_from_fasta(fasta_file, length_threshold, kmer_len, outfile)
\ No newline at end of file
+    generate_features_from_fasta(fasta_file, length_threshold, kmer_len, outfile, cache_dir)
\ No newline at end of file
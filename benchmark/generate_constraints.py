@@ -3,11 +3,10 @@ A script to generate must-link and cannot-link constrains.
 """
 import argparse
 import pandas as pd
-from Bio import SeqIO
 import math
-import numpy as np
 import random
 import os
+from fasta_utils import load_fai, get_threshold, is_binned_short
 
 
 def generate_CAT(cat_result):
@@ -110,42 +109,14 @@ def generate_mmseqs(mmseqs_file):
     return cannot_link_species, cannot_link_genus, cannot_link_mix, must_link_species
 
 
-def get_threshold(contig_len):
-    """
-    calculate the threshold length for must link breaking up
-    """
-    basepair_sum = 0
-    threshold = 0
-    whole_len = np.sum(contig_len)
-    contig_len.sort(reverse=True)
-    index = 0
-    while(basepair_sum / whole_len < 0.98):
-        basepair_sum += contig_len[index]
-        threshold = contig_len[index]
-        index += 1
-    threshold = max(threshold, 4000)
-    return threshold
-
-
 def generate_file(annotation_file, contig_file, output,SolidBin = False, tool=None):
-    whole_contig_bp = 0
-    contig_bp_2500 = 0
-    contig_length_list = []
-    for seq_record in SeqIO.parse(contig_file, "fasta"):
-        if len(seq_record) >= 1000 and len(seq_record) <= 2500:
-            contig_bp_2500 += len(seq_record)
-        whole_contig_bp += len(seq_record)
-        contig_length_list.append(len(seq_record))
-
-    must_link_threshold = get_threshold(contig_length_list)
-    binned_short = contig_bp_2500 / whole_contig_bp < 0.05
-    threshold = 1000 if binned_short else 2500
-    namelist = []
+    fai = load_fai(contig_file)
+    contig_len = fai['length'].values
 
-
-    for seq_record in SeqIO.parse(contig_file, "fasta"):
-        if len(seq_record) > threshold:
-            namelist.append(seq_record.id)
+    must_link_threshold = get_threshold(contig_len)
+    binned_short = is_binned_short(contig_len)
+    threshold = 1000 if binned_short else 2500
+    namelist = fai['name'].values[contig_len > threshold].tolist()
 
     os.makedirs(output, exist_ok=True)
 
@@ -0,0 +1,289 @@
+"""
+Marker gene scan of the whole assembly.
+
+FragGeneScan and hmmsearch (with marker.hmm) are run once on the full contig
+fasta; seed selection for all bins then works on the parsed hits. The hits of
+a contig do not depend on which other contigs are searched with it: genes
+are predicted per contig and `--cut_tc` applies per-sequence thresholds.
+"""
+import os
+import re
+import json
+import zlib
+import hashlib
+import numpy as np
+import pandas as pd
+from tool_runner import run_command
+from disk_cache import DiskCache, DEFAULT_MAX_BYTES
+
+
+# the ORF -> contig pattern of test_getmarker.pl (ORFs are <contig>_<start>_<end>_<strand>)
+ORF_PATTERN = re.compile(r'''([A-Za-z0-9._:;'"`=~:!@#$%^&*(){}\[\]\\/?<>\-|]+)_[0-9]+_[0-9]+_[+\-]$''')
+
+
+def _read_key(key_file):
+    if not os.path.exists(key_file):
+        return None
+    with open(key_file) as f:
+        return f.read().strip()
+
+
+def _write_key(key_file, key):
+    if key is None:
+        return
+    with open(key_file + '.tmp', 'w') as out:
+        out.write(key + '\n')
+    os.replace(key_file + '.tmp', key_file)
+
+
+def run_marker_scan(contig_fasta, output_dir, threads=48, timeout=None, report=None, cache=None,
+                    key=None, force=False):
+    """
+    Run gene calling and the marker HMM search on the whole assembly
+
+    The outputs of an earlier call in `output_dir` are reused when they were
+    made with the same `key` (a hash of the assembly and the marker models),
+    and recomputed with `force`. With a MarkerCache, the domain table of an
+    assembly with the same content is reused instead of running the tools.
+
+    Failures and timeouts raise tool_runner.ToolError. Returns the path of
+    the hmmsearch domain table
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    contig_output = os.path.join(output_dir, 'contigs.frag')
+    hmm_output = os.path.join(output_dir, 'contigs.hmmout')
+    key_file = os.path.join(output_dir, 'contigs.key')
+    if force or _read_key(key_file) != key:
+        for path in [key_file, hmm_output, contig_output + '.faa']:
+            if os.path.exists(path):
+                os.remove(path)
+    elif os.path.exists(hmm_output):
+        return hmm_output
+    if cache is not None:
+        assembly_key = cache.assembly_key(contig_fasta)
+        if cache.get_domtblout(assembly_key, hmm_output):
+            _write_key(key_file, key)
+            return hmm_output
+
+    if not os.path.exists(contig_output + '.faa'):
+        # outputs are only moved into place once the tool completed
+        run_command('FragGeneScan',
+                    ['run_FragGeneScan.pl',
+                     '-genome={}'.format(contig_fasta),
+                     '-out={}'.format(contig_output + '.tmp'),
+                     '-complete=0',
+                     '-train=complete',
+                     '-thread={}'.format(threads),
+                     ],
+                    contig_output + '.out', timeout=timeout, report=report)
+        os.replace(contig_output + '.tmp.faa', contig_output + '.faa')
+
+    if not os.path.exists(hmm_output):
+        run_command('hmmsearch',
+                    ['hmmsearch',
+                     '--domtblout',
+                     hmm_output + '.tmp',
+                     '--cut_tc',
+                     '--cpu', str(threads),
+                     'marker.hmm',
+                     contig_output + '.faa',
+                     ],
+                    hmm_output + '.out', timeout=timeout, report=report)
+        os.replace(hmm_output + '.tmp', hmm_output)
+    if cache is not None:
+        cache.put_domtblout(assembly_key, hmm_output)
+    _write_key(key_file, key)
+    return hmm_output
+
+
+def _file_digest(path, h=None):
+    h = hashlib.sha256() if h is None else h
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h
+
+
+class MarkerCache(DiskCache):
+    """
+    Marker scan results shared across runs, keyed by content hashes:
+
+    - the hmmsearch domain table of a whole assembly (hash of the fasta);
+    - the seeds of a bin (hash of its sorted contig names and sequence lines,
+      and of the minimum contig length).
+
+    Both keys include the hash of the marker models, so that results are not
+    reused after marker.hmm changes. The binning variants of a sample
+    (NoSemi, m, c, mc) share many identical bins: only the contigs of the
+    bins not found need to be scanned, and when every bin of a run is found
+    the marker scan is skipped altogether.
+    """
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES, marker_hmm='marker.hmm'):
+        super(MarkerCache, self).__init__(cache_dir, max_bytes, name='markers')
+        self.model_digest = _file_digest(marker_hmm).hexdigest() if os.path.exists(marker_hmm) else ''
+
+    def assembly_key(self, contig_fasta):
+        h = hashlib.sha256(b'assembly:' + self.model_digest.encode() + b':')
+        return _file_digest(contig_fasta, h).hexdigest()
+
+    def get_domtblout(self, key, hmm_output):
+        """
+        Write the cached domain table to `hmm_output`; returns whether it was found
+        """
+        value = self.get(key)
+        if value is None:
+            return False
+        with open(hmm_output + '.tmp', 'wb') as out:
+            out.write(zlib.decompress(value))
+        os.replace(hmm_output + '.tmp', hmm_output)
+        return True
+
+    def put_domtblout(self, key, hmm_output):
+        with open(hmm_output, 'rb') as f:
+            self.put(key, zlib.compress(f.read()))
+
+    def bin_key(self, contigs, fasta, min_len):
+        """
+        contigs: names of the contigs in the bin (any order)
+        fasta: fasta_utils.IndexedFasta; the sequence lines are hashed as
+        stored, without decoding them
+        """
+        h = hashlib.sha256('bin:{}:{}:'.format(self.model_digest, min_len).encode())
+        for contig in sorted(contigs):
+            h.update(contig.encode())
+            h.update(b'\n')
+            h.update(fasta.raw(contig))
+            h.update(b'\n')
+        return h.hexdigest()
+
+    def get_bin(self, key):
+        """
+        Returns the seeds of a cached bin ([] for a bin without seeds), or
+        None when the bin is not cached
+        """
+        value = self.get(key)
+        if value is None:
+            return None
+        return json.loads(zlib.decompress(value).decode())['seeds'] or []
+
+    def put_bin(self, key, seeds):
+        self.put(key, zlib.compress(json.dumps({'seeds': seeds}).encode()))
+
+
+# test_getmarker.pl counts these pairs of models as the same marker
+MARKER_ALIASES = {
+    'TIGR00388': 'TIGR00389',
+    'TIGR00471': 'TIGR00472',
+    'TIGR00408': 'TIGR00409',
+    'TIGR02386': 'TIGR02387',
+}
+COV_CUTOFF = 0.4
+
+
+def parse_domtblout(hmm_output):
+    """
+    Parse an hmmsearch domain table into a columnar table (in file order)
+    with columns contig, marker, qlen, hmm_from and hmm_to
+    """
+    orfs = []
+    markers = []
+    qlen = []
+    hmm_from = []
+    hmm_to = []
+    with open(hmm_output) as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            tokens = line.split()
+            orfs.append(tokens[0])
+            markers.append(tokens[3])
+            qlen.append(tokens[5])
+            hmm_from.append(tokens[15])
+            hmm_to.append(tokens[16])
+    hits = pd.DataFrame({
+        'contig': pd.Series(orfs, dtype=object).str.extract(ORF_PATTERN, expand=False),
+        'marker': pd.Series(markers, dtype=object).replace(MARKER_ALIASES),
+        'qlen': np.array(qlen, dtype=np.int64),
+        'hmm_from': np.array(hmm_from, dtype=np.int64),
+        'hmm_to': np.array(hmm_to, dtype=np.int64),
+        })
+    return hits[hits['contig'].notna()].reset_index(drop=True)
+
+
+def select_seeds(hits, contig_bin, contig_length, min_len):
+    """
+    Seed contigs of every bin, computed for all bins at once with the rules
+    of test_getmarker.pl:
+
+    - only hits on contigs of at least `min_len` bp are considered;
+    - consecutive hits of the same marker form a group, and a contig counts
+      for a group if one of its hits covers >= 40% of the marker model;
+    - the seeds are the contigs of the group with the median count (over
+      groups with any contig), choosing the shortest marker model (first
+      group on ties; Perl picks one at random); there are no seeds when the
+      median is at most 1.
+
+    hits: output of parse_domtblout
+    contig_bin: dict contig -> bin label
+    contig_length: dict contig -> length
+
+    Returns a dict bin label -> list of seed contigs
+    """
+    hits = hits.assign(bin=hits['contig'].map(contig_bin),
+                       length=hits['contig'].map(contig_length))
+    hits = hits[hits['bin'].notna() & (hits['length'] >= min_len)]
+    if not len(hits):
+        return {}
+    hits = hits.assign(order=np.arange(len(hits)))
+    hits = hits.sort_values(['bin', 'order'], kind='stable')
+
+    bins = hits['bin'].values
+    markers = hits['marker'].values
+    new_group = np.ones(len(hits), dtype=bool)
+    new_group[1:] = (bins[1:] != bins[:-1]) | (markers[1:] != markers[:-1])
+    hits['group'] = np.cumsum(new_group)
+    group_qlen = hits['qlen'].values[new_group]
+
+    covered = hits[(hits['hmm_to'] - hits['hmm_from']) / hits['qlen'] >= COV_CUTOFF]
+    members = covered.drop_duplicates(['group', 'contig'])
+    groups = members.groupby('group', sort=True).agg(bin=('bin', 'first'),
+                                                      marker=('marker', 'first'),
+                                                      count=('contig', 'size'))
+    groups['qlen'] = group_qlen[groups.index.values - 1]
+
+    # median number of contigs per group: sorted counts at position n // 2
+    ranked = groups.sort_values(['bin', 'count'], kind='stable')
+    position = ranked.groupby('bin').cumcount()
+    size = ranked.groupby('bin')['count'].transform('size')
+    median = ranked[position == size // 2].set_index('bin')['count']
+
+    # only the last group of a marker can be picked, as in the Perl hash
+    candidates = groups.drop_duplicates(['bin', 'marker'], keep='last')
+    candidates = candidates[candidates['count'].values == median.reindex(candidates['bin']).values]
+    candidates = candidates[candidates['count'] > 1]
+    chosen = candidates.sort_values(['bin', 'qlen'], kind='stable').drop_duplicates('bin')
+
+    seeds = members[members['group'].isin(chosen.index)]
+    return {int(label): contigs.tolist() for label, contigs in seeds.groupby('bin')['contig']}
+
+
+def main():
+    """
+    Drop-in replacement of `perl test_getmarker.pl <hmmout> <bin fasta> <min length> <seed output>`
+    """
+    import sys
+    from fasta_utils import iter_fasta_lengths
+    hmm_output, fasta_path, min_len, seed_output = sys.argv[1:5]
+    contig_length = dict(iter_fasta_lengths(fasta_path))
+    seeds = select_seeds(parse_domtblout(hmm_output),
+                         dict.fromkeys(contig_length, 0),
+                         contig_length,
+                         int(min_len))
+    if 0 in seeds:
+        with open(seed_output, 'w') as out:
+            for contig in seeds[0]:
+                out.write(contig + '\n')
+
+
+if __name__ == '__main__':
+    main()
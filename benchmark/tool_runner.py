@@ -0,0 +1,157 @@
+"""
+Run external tools (FragGeneScan, hmmsearch, ...) with asyncio, with per-call
+timeouts and the tail of stderr kept for diagnostics. Every call (and every
+step timed with `RunReport.timed`) is recorded with its wall time and exit
+status in a JSON run report.
+"""
+import asyncio
+import collections
+import json
+import os
+import signal
+import time
+from contextlib import contextmanager
+
+
+STDERR_TAIL_LINES = 20
+STDERR_BLOCK = 64 * 1024
+
+
+class ToolError(Exception):
+    def __init__(self, record):
+        self.record = record
+        if not record['started']:
+            reason = 'failed to start'
+        elif record['timed_out']:
+            reason = 'timed out after {:.0f}s'.format(record['wall_time'])
+        else:
+            reason = 'exited with status {}'.format(record['returncode'])
+        message = '{} {}'.format(record['name'], reason)
+        if record['stderr_tail']:
+            message += ':\n' + record['stderr_tail']
+        super(ToolError, self).__init__(message)
+
+
+class RunReport(object):
+    """
+    Collects per-step records and saves them to `path` (if given) after each one
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.records = []
+
+    def add(self, record):
+        self.records.append(record)
+        self.save()
+
+    @contextmanager
+    def timed(self, name, **info):
+        """
+        Record the wall time and status of an in-process step; extra
+        fields can be added to the yielded record
+        """
+        record = dict(name=name, status='ok', **info)
+        start = time.time()
+        try:
+            yield record
+        except Exception as e:
+            record['status'] = 'failed'
+            record['error'] = str(e)
+            raise
+        finally:
+            record['wall_time'] = time.time() - start
+            self.add(record)
+
+    def save(self):
+        if self.path is None:
+            return
+        with open(self.path + '.tmp', 'w') as out:
+            json.dump(self.records, out, indent=2)
+        os.replace(self.path + '.tmp', self.path)
+
+
+async def _read_tail(stream, tail):
+    """
+    Read `stream` to the end, keeping its last lines in the deque `tail`
+    """
+    partial = b''
+    while True:
+        block = await stream.read(STDERR_BLOCK)
+        if not block:
+            break
+        lines = (partial + block).split(b'\n')
+        partial = lines.pop()[-STDERR_BLOCK:]
+        tail.extend(lines)
+    if partial:
+        tail.append(partial)
+
+
+async def _run_command(name, cmd, stdout, timeout):
+    start = time.time()
+    stdout_file = open(stdout, 'w') if stdout is not None else None
+    try:
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=stdout_file if stdout_file is not None else asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True)
+        except OSError as e:
+            # e.g. the tool is not installed
+            return {
+                'name': name,
+                'cmd': cmd,
+                'status': 'failed',
+                'started': False,
+                'returncode': None,
+                'timed_out': False,
+                'wall_time': time.time() - start,
+                'stderr_tail': str(e),
+            }
+        # stderr is read on its own, so that what a hung tool wrote before
+        # the timeout is kept
+        tail = collections.deque(maxlen=STDERR_TAIL_LINES)
+        reader = asyncio.ensure_future(_read_tail(process.stderr, tail))
+        timed_out = False
+        try:
+            await asyncio.wait_for(process.wait(), timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+            # kill the whole process group (wrapper scripts spawn the actual tool)
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            await process.wait()
+        await reader
+    finally:
+        if stdout_file is not None:
+            stdout_file.close()
+    stderr_lines = [line.decode(errors='replace').rstrip('\r') for line in tail]
+    return {
+        'name': name,
+        'cmd': cmd,
+        'status': 'timeout' if timed_out else ('ok' if process.returncode == 0 else 'failed'),
+        'started': True,
+        'returncode': process.returncode,
+        'timed_out': timed_out,
+        'wall_time': time.time() - start,
+        'stderr_tail': '\n'.join(stderr_lines),
+    }
+
+
+def run_command(name, cmd, stdout=None, timeout=None, report=None):
+    """
+    cmd: argv of the tool
+    stdout: path its standard output is written to (None: discarded)
+    timeout: seconds allowed to the call (None: no limit)
+
+    Runs the command and returns its record. Raises ToolError when the
+    tool could not be started, failed or timed out.
+    """
+    record = asyncio.run(_run_command(name, cmd, stdout, timeout))
+    if report is not None:
+        report.add(record)
+    if record['status'] != 'ok':
+        raise ToolError(record)
+    return record